@@ -2,20 +2,33 @@ from PIL import Image
 import streamlit as st
 import os
 from datetime import datetime
-from mcp_client import MCPClient
+from mcp_client import MCPClient, json_default, build_system_prompt, KEEP_LAST_TURNS
+from mcp.types import CallToolResult, TextContent
+from anthropic.types import Message, ToolUseBlock
 import asyncio
 from dotenv import load_dotenv
 import logging
-import json
+from logging_config import configure_logging
+import orjson
 import time
 from typing import Any, List, Dict, Optional, Union
 import random
+import functools
+import html
+import uuid
+import state_store
 
 load_dotenv()
 
 # Global theme color constant
 THEME_COLOR = "#0077ff"  # Default blue theme
 
+# Complementary colors for visual hierarchy, derived from the theme color
+_R, _G, _B = bytes.fromhex(THEME_COLOR[1:])
+LIGHT_THEME = f"rgba({_R}, {_G}, {_B}, 0.1)"
+MEDIUM_THEME = f"rgba({_R}, {_G}, {_B}, 0.3)"
+DARK_THEME = f"rgba({max(0, _R - 40)}, {max(0, _G - 40)}, {max(0, _B - 40)}, 1.0)"
+
 icons = {
     "user": "./assets/user.svg",
     "assistant": "./assets/rapidata.png",
@@ -23,18 +36,31 @@ icons = {
     "tool_result": "./assets/chart-gantt.svg",
 }
 
+# MCP servers by tool group, given as the environment variable holding the server path
+TOOL_GROUP_PATH_ENV_VARS = {
+    "rapidata": "PATH_TO_RAPIDATA_MCP",
+    "imagegen": "PATH_TO_IMAGE_GENERATION_MCP",
+}
+# What each tool group is for, tells the model which group to activate before its tools are known
+TOOL_GROUP_DESCRIPTIONS = {
+    "rapidata": "ask real humans to answer questions, classify, rank and compare images and texts",
+    "imagegen": "generate images from text prompts and save them to disk",
+}
+# Tool groups connected on startup, the others are activated on demand by the model
+DEFAULT_TOOL_GROUPS = {"rapidata"}
+
 if os.name == 'nt':
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+else:
+    # uvloop is a faster drop-in event loop, only available on Linux/macOS
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("rapidata_mcp.log"),
-        logging.StreamHandler()
-    ]
-)
+configure_logging("rapidata_mcp.log")
 logger = logging.getLogger(__name__)
 
 
@@ -52,12 +78,55 @@ def initialize_session_state():
         st.session_state.sidebar_visible = True
     if "model" not in st.session_state:
         st.session_state.model = "claude-3-7-sonnet-20250219"
-    if "previous_model" not in st.session_state:
-        st.session_state.previous_model = st.session_state.model
+    if "keep_turns" not in st.session_state:
+        st.session_state.keep_turns = KEEP_LAST_TURNS
+    if "compaction" not in st.session_state:
+        st.session_state.compaction = None  # (split index, summary task) while a summary is made
     if "animation_speed" not in st.session_state:
         st.session_state.animation_speed = 50  # milliseconds
 
 
+def new_conversation_id() -> str:
+    """Start a new stored conversation, its id is kept in the URL so reloading the page continues it"""
+    conversation_id = uuid.uuid4().hex
+    st.query_params["conversation"] = conversation_id
+    return conversation_id
+
+
+async def restore_conversation(client: MCPClient):
+    """Continue the conversation of the URL if it is in the state store
+
+    Streamlit sessions don't survive a server restart and aren't shared between
+    replicas, the conversation id in the URL is.
+
+    Args:
+        client: The session's MCPClient view, gets the full text of the shortened tool results
+    """
+    conversation_id = st.query_params.get("conversation")
+    stored = await state_store.load_conversation(conversation_id) if conversation_id else None
+    if stored:
+        st.session_state.messages = stored["messages"]
+        st.session_state.conversation_history = stored["history"]
+        client.tool_result_store = stored.get("tool_results", {})
+        st.session_state.compaction = None
+    st.session_state.conversation_id = conversation_id or new_conversation_id()
+
+
+def reset_conversation(client: MCPClient):
+    """Start a new conversation, the stored one is left to expire"""
+    st.session_state.messages = []
+    st.session_state.conversation_history = []
+    client.tool_result_store = {}
+    # The prefix sent before belongs to the old conversation
+    client.history_checkpoint = None
+    # A summary still being made belongs to the old conversation
+    if st.session_state.compaction is not None:
+        st.session_state.compaction[1].cancel()
+        st.session_state.compaction = None
+    if state_store.STORE_ENABLED:
+        st.session_state.conversation_id = new_conversation_id()
+
+
 def set_api_key():
     """Set the API key and update session state"""
     if st.session_state.claude_api_key:
@@ -68,40 +137,331 @@ def set_api_key():
         st.error("Please enter an API key.")
 
 
-async def initialize_client(model: str = "claude-3-7-sonnet-20250219") -> MCPClient:
-    """Initialize the MCPClient if it hasn't been initialized yet"""
+async def initialize_client(model: str = "claude-3-7-sonnet-20250219", groups: set[str] = DEFAULT_TOOL_GROUPS) -> MCPClient:
+    """Initialize the MCPClient if it hasn't been initialized yet
+
+    Only the servers of the requested tool groups are connected, the other groups are
+    registered so the model can activate them when it needs their tools.
+    """
     client = MCPClient(model=model)
-    rapidata_mcp_path = os.environ.get("PATH_TO_RAPIDATA_MCP")
-    if rapidata_mcp_path:
-        await client.connect_to_server(rapidata_mcp_path)
-    else:
-        logger.warning("Rapidata MCP path not found")
-    image_generation_mcp_path = os.environ.get("PATH_TO_IMAGE_GENERATION_MCP")
-    if image_generation_mcp_path:
-        await client.connect_to_server(image_generation_mcp_path)
-    else:
-        logger.warning("Image generation MCP path not found")
-    
+    for group, env_var in TOOL_GROUP_PATH_ENV_VARS.items():
+        server_path = os.environ.get(env_var)
+        if not server_path:
+            logger.warning(f"{group} MCP path not found ({env_var})")
+            continue
+        client.register_server_group(group, server_path, TOOL_GROUP_DESCRIPTIONS.get(group, ""))
+
+    # The servers of the requested groups are connected concurrently, meanwhile
+    # the prompting guide is read in a worker thread instead of by the first request
+    await asyncio.gather(
+        client.activate_groups([group for group in groups if group in client.server_groups]),
+        asyncio.to_thread(build_system_prompt),
+    )
+
     return client
 
 
+@st.cache_resource
+def get_shared_client_task() -> asyncio.Task:
+    """Start connecting the MCP servers once per Streamlit process
+
+    The MCPClient and its server subprocesses are shared by all sessions, each
+    session works on its own view of it (see MCPClient.create_view).
+    """
+    return asyncio.get_running_loop().create_task(initialize_client())
+
+
+async def get_shared_client() -> MCPClient:
+    """Get the MCPClient shared by all sessions, waiting for its servers to be connected"""
+    task = get_shared_client_task()
+    try:
+        return await task
+    except Exception:
+        # Don't keep a failed connection attempt cached, the next session retries
+        get_shared_client_task.clear()
+        raise
+
+
 def format_tool_input(tool_input: Dict[str, Any]) -> str:
     """Format tool input for display in a more readable way"""
     try:
-        formatted = json.dumps(tool_input, indent=2)
-        return formatted
-    except:
+        return orjson.dumps(tool_input, default=json_default, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    except orjson.JSONEncodeError:
         return str(tool_input)
 
 
+@functools.singledispatch
+def extract_text(item: Any) -> Optional[str]:
+    """Get the text of a tool result item, None if it has no text"""
+    text = getattr(item, 'text', None)
+    return text.strip() if isinstance(text, str) else None
+
+
+@extract_text.register
+def _(item: TextContent) -> Optional[str]:
+    return item.text.strip()
+
+
+@extract_text.register
+def _(item: str) -> Optional[str]:
+    return item.strip()
+
+
+@extract_text.register
+def _(item: dict) -> Optional[str]:
+    return item['text'].strip() if 'text' in item else None
+
+
+def format_tool_result(tool_result: CallToolResult) -> str:
+    """Format a tool result for display"""
+    if isinstance(tool_result.content, list):
+        # Extract text from TextContent objects if it's a list of objects, skipping items without text
+        texts = (extract_text(item) for item in tool_result.content)
+        return ", ".join(text for text in texts if text is not None)
+
+    # If it's not a list, just use the content directly
+    return str(tool_result.content)
+
+
+def message_html(message: Dict[str, Any]) -> str:
+    """Compose the header and body of a tool call or tool result message as one HTML block"""
+    if message["type"] == "tool_call":
+        tool_name = html.escape(message.get("name", "Unknown Tool"))
+        header = f"<div class='tool-header'><span class='tool-name'>{tool_name}</span> Tool</div>"
+        body = format_tool_input(message["content"])
+    else:
+        tool_name = html.escape(message.get("for_tool", "Tool"))
+        header = f"<div class='result-header'>Result from <span class='tool-name'>{tool_name}</span></div>"
+        body = message["content"]
+
+    # Newlines as character references keep the block on a single line, markdown would end the HTML block at a blank line
+    body = html.escape(body).replace("\n", "&#10;")
+    return f"{header}<pre><code>{body}</code></pre>"
+
+
+def render_message(message: Dict[str, Any], live: bool = False):
+    """Display a chat message stored in st.session_state.messages
+
+    Args:
+        message: The message to display
+        live: Whether the message is displayed for the first time. A live tool call
+            shows its input as an interactive tree, the history replay uses the
+            pre-composed HTML of the message instead
+    """
+    role = message["role"]
+    content = message["content"]
+    msg_type = message.get("type", "text")
+
+    # Different avatars based on message type
+    avatar = icons["user"] if role == "user" else icons["assistant"]
+    if msg_type == "tool_call":
+        avatar = icons["tool"]
+    elif msg_type == "tool_result":
+        avatar = icons["tool_result"]
+
+    with st.chat_message(role, avatar=avatar):
+        if msg_type == "text":
+            st.write(content)
+        elif msg_type == "tool_call" and live:
+            tool_name = message.get("name", "Unknown Tool")
+            st.markdown(f"<div class='tool-header'><span class='tool-name'>{html.escape(tool_name)}</span> Tool</div>", unsafe_allow_html=True)
+            st.json(content)
+        else:
+            # Older messages may not have the pre-composed HTML
+            st.markdown(message.get("_html") or message_html(message), unsafe_allow_html=True)
+
+
+def render_chat_history():
+    """Display the chat history"""
+    for message in st.session_state.messages:
+        render_message(message)
+
+
+async def run_tool(client: MCPClient, tool_use: ToolUseBlock, result_placeholder) -> tuple[CallToolResult, Dict[str, Any]]:
+    """Execute a tool call and display its result in the placeholder reserved for it
+
+    Args:
+        client: MCPClient instance
+        tool_use: The tool_use block from Claude's response
+        result_placeholder: st.empty() placeholder the result is rendered into
+
+    Returns:
+        The tool result and the chat message displaying it
+    """
+    tool_result = await client.use_tool(tool_use.name, tool_use.input, tool_use.id)
+    formatted_result = format_tool_result(tool_result)
+
+    tool_result_msg = {
+        "role": "assistant",
+        "content": formatted_result,
+        "type": "tool_result",
+        "for_tool": tool_use.name,
+    }
+    # Compose the HTML once, the history replay reuses it
+    tool_result_msg["_html"] = message_html(tool_result_msg)
+
+    # Display the formatted tool result with proper styling
+    with result_placeholder.container():
+        render_message(tool_result_msg)
+
+    return tool_result, tool_result_msg
+
+
+async def stream_chat_response(client: MCPClient, history: List[Dict]) -> Message:
+    """Get a response from Claude, displaying its text while it is being generated
+
+    The chat message is only created once the first text arrives, so responses
+    that only contain tool calls don't leave an empty message behind. Tool calls
+    are taken from the final message once the stream is complete. The event loop
+    keeps running other tasks while waiting for the next delta.
+
+    Args:
+        client: MCPClient instance
+        history: Messages to send to Claude
+
+    Returns:
+        The complete Claude Message response
+    """
+    placeholder = None
+    text_content = ""
+    async with client.stream_response(history) as stream:
+        async for text in stream.text_stream:
+            if placeholder is None:
+                with st.chat_message("assistant", avatar=icons["assistant"]):
+                    placeholder = st.empty()
+            text_content += text
+            placeholder.markdown(text_content)
+        response = await stream.get_final_message()
+
+    if text_content:
+        st.session_state.messages.append({"role": "assistant", "content": text_content, "type": "text"})
+
+    return response
+
+
+def split_response_content(response: Message) -> tuple[List[Dict], List[ToolUseBlock]]:
+    """Split a Claude response into the content of its assistant message and its tool calls
+
+    Args:
+        response: The Claude Message response
+
+    Returns:
+        The assistant message content for the conversation history and the tool_use blocks
+    """
+    assistant_content = []
+    tool_uses = []
+    for content in response.content:
+        if content.type == 'text':
+            assistant_content.append({"type": "text", "text": content.text})
+        elif content.type == 'tool_use':
+            tool_uses.append(content)
+            assistant_content.append({
+                "type": "tool_use",
+                "id": content.id,
+                "name": content.name,
+                "input": content.input
+            })
+    return assistant_content, tool_uses
+
+
+async def run_tool_calls(client: MCPClient, tool_uses: List[ToolUseBlock]) -> List[Dict]:
+    """Display and concurrently execute the tool calls of a response
+
+    Args:
+        client: MCPClient instance
+        tool_uses: The tool_use blocks from Claude's response
+
+    Returns:
+        The tool_result blocks for the conversation history, in the order of the tool calls
+    """
+    # Display every tool call and reserve a spot for its result before running them
+    tool_call_msgs = []
+    result_placeholders = []
+    for tool_use in tool_uses:
+        tool_call_msg = {
+            "role": "assistant",
+            "content": tool_use.input,
+            "type": "tool_call",
+            "name": tool_use.name,
+            "id": tool_use.id,
+        }
+        # Compose the HTML once for the history replay, the live display shows the input as a tree
+        tool_call_msg["_html"] = message_html(tool_call_msg)
+        render_message(tool_call_msg, live=True)
+        tool_call_msgs.append(tool_call_msg)
+        result_placeholders.append(st.empty())
+
+    # Execute the independent tool calls concurrently with a progress animation
+    tool_names = ", ".join(tool_use.name for tool_use in tool_uses)
+    with st.spinner(f"Running tools: {tool_names}..."):
+        tool_results = await asyncio.gather(*[
+            run_tool(client, tool_use, result_placeholder)
+            for tool_use, result_placeholder in zip(tool_uses, result_placeholders)
+        ])
+
+    # Store tool calls and results in session state, in the order they are displayed
+    for tool_call_msg, (_, tool_result_msg) in zip(tool_call_msgs, tool_results):
+        st.session_state.messages.append(tool_call_msg)
+        st.session_state.messages.append(tool_result_msg)
+
+    return [
+        {
+            "type": "tool_result",
+            "tool_use_id": tool_use.id,
+            # Sent whole during the turn, long results are shortened when the turn is committed
+            "content": tool_result.content
+        }
+        for tool_use, (tool_result, _) in zip(tool_uses, tool_results)
+    ]
+
+
+def start_compaction(client: MCPClient):
+    """Start summarizing the oldest turns in the background if the history got too long
+
+    The summary runs on the app's event loop alongside the next turns, which go on
+    with the full history until apply_compaction swaps it in.
+    """
+    if st.session_state.compaction is not None:
+        return
+    history = st.session_state.conversation_history
+    split_index = client.compaction_split(history, keep_turns=st.session_state.keep_turns)
+    if split_index is None:
+        return
+    summary_task = asyncio.get_running_loop().create_task(client.summarize_history(history[:split_index]))
+    st.session_state.compaction = (split_index, summary_task)
+
+
+def apply_compaction(client: MCPClient):
+    """Replace the oldest turns with their summary if it is ready
+
+    The history is append only until then, so the split computed when the summary was
+    started still points at the same message.
+    """
+    if st.session_state.compaction is None:
+        return
+    split_index, summary_task = st.session_state.compaction
+    if not summary_task.done():
+        return
+    st.session_state.compaction = None
+    summary_text = summary_task.result()
+    if summary_text is not None:
+        st.session_state.conversation_history = client.apply_summary(
+            st.session_state.conversation_history, split_index, summary_text
+        )
+
+
 async def get_chat_response(query: str, client: MCPClient) -> str:
     """
     Get a response from Claude API, maintaining conversation history
-    
+
+    The request is assembled as [committed history | pending turn]. The committed
+    history only grows once a turn is finished, while the tool_use/tool_result
+    exchanges of the current turn are kept in the pending list until then.
+
     Args:
         query: User's query text
         client: MCPClient instance
-        
+
     Returns:
         Response from Claude
     """
@@ -109,132 +469,65 @@ async def get_chat_response(query: str, client: MCPClient) -> str:
     if "conversation_history" not in st.session_state:
         st.session_state.conversation_history = []
 
-    # Add current user query to conversation history
-    st.session_state.conversation_history.append({
-        "role": "user", 
+    # Swap in the summary of the oldest turns once it is ready, between turns
+    apply_compaction(client)
+
+    # The committed history does not change during this turn, the client caches it as a prompt prefix
+    history = st.session_state.conversation_history
+
+    # Current user query starts the pending turn
+    pending = [{
+        "role": "user",
         "content": [{"type": "text", "text": query}]
-    })
-    
-    # Get response using the full conversation history
-    response = await client.get_response(history=st.session_state.conversation_history)
+    }]
+
+    # Get response using the committed history plus the pending turn
+    response = await stream_chat_response(client, history + pending)
 
+    # Each step is one Claude round trip followed by one batch of tool calls
     while True:
-        has_tool_calls = False
-
-        # Process text content
-        text_content = ""
-        for content in response.content:
-            if content.type == 'text':
-                text_content += content.text
-        
-        if text_content:
-            st.session_state.messages.append({"role": "assistant", "content": text_content, "type": "text"})
-            with st.chat_message("assistant", avatar=icons["assistant"]):
-                st.write(text_content)
-
-        # Create assistant message for conversation history
-        assistant_content = []
-        for content in response.content:
-            if content.type == 'text':
-                assistant_content.append({"type": "text", "text": content.text})
-            elif content.type == 'tool_use':
-                has_tool_calls = True
-                assistant_content.append({
-                    "type": "tool_use",
-                    "id": content.id,
-                    "name": content.name,
-                    "input": content.input
-                })
-                
-                # Store tool call info in session state
-                tool_call_msg = {"role": "assistant", "content": content.input, "type": "tool_call", "name": content.name, "id": content.id}
-                st.session_state.messages.append(tool_call_msg)
-                
-                # Display animated tool call in UI
-                with st.chat_message("assistant", avatar=icons["tool"]):
-                    tool_container = st.container()
-                    with tool_container:
-                        st.markdown(f"<div class='tool-header'><span class='tool-name'>{content.name}</span> Tool</div>", unsafe_allow_html=True)
-                        st.json(content.input)
-
-                # Execute the tool with a progress animation
-                with st.spinner(f"Running tool: {content.name}..."):
-                    tool_result = await client.use_tool(content.name, content.input, content.id)
-
-                # Format tool result for display
-                formatted_result = ""
-                if isinstance(tool_result.content, list):
-                    # Extract text from TextContent objects if it's a list of objects
-                    text_items = []
-                    for item in tool_result.content:
-                        if hasattr(item, 'text'):
-                            text_items.append(item.text.strip())
-                        elif isinstance(item, str):
-                            text_items.append(item.strip())
-                        elif isinstance(item, dict) and 'text' in item:
-                            text_items.append(item['text'].strip())
-                    
-                    formatted_result = ", ".join(text_items)
-                else:
-                    # If it's not a list, just use the content directly
-                    formatted_result = str(tool_result.content)
-
-                # Store and display the tool result in UI
-                tool_result_msg = {"role": "assistant", "content": formatted_result, "type": "tool_result", "for_tool": content.name}
-                st.session_state.messages.append(tool_result_msg)
-                
-                # Display the formatted tool result with proper styling
-                with st.chat_message("assistant", avatar=icons["tool_result"]):
-                    result_container = st.container()
-                    with result_container:
-                        st.markdown(f"<div class='result-header'>Result from <span class='tool-name'>{content.name}</span></div>", unsafe_allow_html=True)
-                        st.markdown(f"```\n{formatted_result}\n```")
-
-                # Add assistant message with tool_use to conversation history
-                st.session_state.conversation_history.append({
-                    "role": "assistant",
-                    "content": assistant_content
-                })
-
-                # Add tool result as user message
-                st.session_state.conversation_history.append({
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "tool_result",
-                            "tool_use_id": content.id,
-                            "content": tool_result.content
-                        }
-                    ]
-                })
-
-                # Get next response from Claude
-                response = await client.get_response(history=st.session_state.conversation_history)
-                break  # Break to process the new response
-        
-        # If no tool calls were made, add the assistant message and exit loop
-        if not has_tool_calls and assistant_content:
-            st.session_state.conversation_history.append({
+        assistant_content, tool_uses = split_response_content(response)
+        if assistant_content:
+            pending.append({
                 "role": "assistant",
                 "content": assistant_content
             })
+
+        # If no tool calls were made the turn is finished
+        if not tool_uses:
             break
-        
-        # If we got an empty response with no tool calls, just exit the loop
-        if not has_tool_calls and not assistant_content:
-            break
-    
+
+        # Add all tool results as a single user message
+        pending.append({
+            "role": "user",
+            "content": await run_tool_calls(client, tool_uses)
+        })
+
+        # Get next response from Claude
+        response = await stream_chat_response(client, history + pending)
+
+    # The turn is finished, commit it to the conversation history (append only)
+    client.commit_turn(st.session_state.conversation_history, pending)
+    start_compaction(client)
+    if state_store.STORE_ENABLED:
+        await state_store.save_conversation(st.session_state.conversation_id, {
+            "messages": st.session_state.messages,
+            "history": st.session_state.conversation_history,
+            # Full text of the shortened tool results, so retrieve_tool_result works after a restore
+            "tool_results": client.tool_result_store,
+        })
+
     return response.content
 
 
 @st.cache_resource
 def get_event_loop():
-    """Get or create an event loop that can be reused"""
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+    """Create the event loop the app runs on, once per process
+
+    Coroutines that need the loop use asyncio.get_running_loop() instead.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     return loop
 
 
@@ -243,29 +536,18 @@ def toggle_sidebar():
     st.session_state.sidebar_visible = not st.session_state.sidebar_visible
 
 
-def on_model_change():
-    """Callback function when model is changed"""
-    if st.session_state.previous_model != st.session_state.model:
-        # Clear conversation history when model changes
-        st.session_state.messages = []
-        st.session_state.conversation_history = []
-        # Update the previous model to current
-        st.session_state.previous_model = st.session_state.model
-        # Update client model if client exists
-        if st.session_state.client:
-            st.session_state.client.model = st.session_state.model
+def on_model_change(client: MCPClient, model: str):
+    """Clear the conversation and switch the client to the newly selected model"""
+    reset_conversation(client)
+    client.model = model
 
 
-def apply_custom_css():
-    """Apply custom CSS for a more visually appealing interface"""
+@st.cache_resource
+def custom_css_html() -> str:
+    """Build the custom CSS once, none of its inputs change at runtime"""
     theme_color = THEME_COLOR
     
-    # Calculate complementary colors for visual hierarchy
-    light_theme = f"rgba({int(theme_color[1:3], 16)}, {int(theme_color[3:5], 16)}, {int(theme_color[5:7], 16)}, 0.1)"
-    medium_theme = f"rgba({int(theme_color[1:3], 16)}, {int(theme_color[3:5], 16)}, {int(theme_color[5:7], 16)}, 0.3)"
-    dark_theme = f"rgba({max(0, int(theme_color[1:3], 16) - 40)}, {max(0, int(theme_color[3:5], 16) - 40)}, {max(0, int(theme_color[5:7], 16) - 40)}, 1.0)"
-    
-    st.markdown(f"""
+    return f"""
     <style>
         /* Overall app styling */
 
@@ -472,7 +754,7 @@ def apply_custom_css():
         }}
         
         .result-header {{
-            background-color: {dark_theme};
+            background-color: {DARK_THEME};
             color: white;
             padding: 8px 15px;
             border-radius: 8px 8px 0 0;
@@ -494,7 +776,7 @@ def apply_custom_css():
         /* User message specific styling */
         
         [data-testid="stChatMessage"] [data-testid="stHorizontalBlock"]:has([data-testid="stChatMessageContent"]) {{
-            background-color: {light_theme};
+            background-color: {LIGHT_THEME};
             border-radius: 12px;
             padding: 0.5rem;
         }}
@@ -502,7 +784,7 @@ def apply_custom_css():
         /* Assistant avatar styling */
 
         .stChatMessage .stAvatar {{
-            border: 2px solid {medium_theme};
+            border: 2px solid {MEDIUM_THEME};
             padding: 2px;
             border-radius: 50%;
             background-color: white;
@@ -537,7 +819,7 @@ def apply_custom_css():
         [data-testid="stSidebar"] .stButton button:active {{
             color: white !important;
             background-color: {theme_color};
-            box-shadow: 0 0 0 0.2rem {medium_theme};
+            box-shadow: 0 0 0 0.2rem {MEDIUM_THEME};
             outline: none;
         }}
         
@@ -606,14 +888,14 @@ def apply_custom_css():
         
         [data-testid="stChatInput"] {{
             border-radius: 12px;
-            border: 2px solid {medium_theme};
+            border: 2px solid {MEDIUM_THEME};
             padding: 0.5rem;
             transition: all 0.3s ease;
         }}
         
         [data-testid="stChatInput"]:focus-within {{
             border-color: {theme_color};
-            box-shadow: 0 0 0 3px {light_theme};
+            box-shadow: 0 0 0 3px {LIGHT_THEME};
         }}
         
         /* Loading animation */
@@ -669,13 +951,73 @@ def apply_custom_css():
             border-radius: .25rem;
         }}
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+
+def apply_custom_css():
+    """Apply custom CSS for a more visually appealing interface
+
+    Streamlit only keeps the elements emitted during a rerun, so the style block
+    is emitted every time, but it is formatted only once per process.
+    """
+    st.markdown(custom_css_html(), unsafe_allow_html=True)
+
+
+@st.cache_resource(show_spinner=False)
+def get_favicon() -> Image.Image:
+    """Load and decode the favicon once per process instead of on every rerun
 
+    No spinner is shown, it would be emitted before st.set_page_config.
+    """
+    with Image.open("./assets/favicon.ico") as im:
+        # Copy so the pixels are loaded and the file can be closed
+        return im.copy()
 
-im = Image.open("./assets/favicon.ico")
 
+@st.fragment
+def sidebar_ui(client: MCPClient):
+    """Display the configuration sidebar
 
-async def main():
+    Runs as a fragment, so changing a setting only reruns the sidebar. Clearing the
+    conversation has to redraw the chat as well, which is why those paths rerun the app.
+    """
+    st.markdown("<h2 style='color: #333; margin-bottom: 20px;'>⚙️ Configuration</h2>", unsafe_allow_html=True)
+    
+    # Add some space between sections
+    st.markdown("### 🤖 AI Model")
+    
+    # Model selection with nicer UI
+    model = st.selectbox(
+        "Select Claude Model",
+        ["claude-3-7-sonnet-20250219", "claude-3-5-sonnet-20240620", "claude-3-haiku-20240307"],
+        index=0,
+        key="model",
+    )
+    
+    # The client keeps the model it was created with, so it tells us if the selection changed
+    if model != client.model:
+        on_model_change(client, model)
+        st.rerun()
+    
+    st.markdown("---")
+    st.markdown("### 💬 Conversation")
+    
+    # Older turns are summarized, which bounds the size of every request
+    st.number_input(
+        "Turns kept verbatim",
+        min_value=1,
+        max_value=50,
+        key="keep_turns",
+        help="Older turns of the conversation are replaced by a summary"
+    )
+    
+    # Add a button to reset the conversation
+    if st.button("🔄 New Conversation", key="new_conversation"):
+        reset_conversation(client)
+        st.rerun()
+
+
+async def main() -> MCPClient:
     initialize_session_state()
     
     # Apply custom styling
@@ -725,60 +1067,43 @@ async def main():
         with st.spinner("Initializing client..."):
             # Get the selected model from the selectbox
             model = st.session_state.get("model", "claude-3-7-sonnet-20250219")
-            st.session_state.client = await initialize_client(model)
+            shared_client = await get_shared_client()
+            st.session_state.client = shared_client.create_view(model)
             st.session_state.client_initialized = True
     
     client = st.session_state.client
+
+    # Needs the session's client view, which gets the stored tool results
+    if state_store.STORE_ENABLED and "conversation_id" not in st.session_state:
+        await restore_conversation(client)
     
     # Sidebar for configuration
     with st.sidebar:
-        st.markdown("<h2 style='color: #333; margin-bottom: 20px;'>⚙️ Configuration</h2>", unsafe_allow_html=True)
-        
-        # Add some space between sections
-        st.markdown("### 🤖 AI Model")
-        
-        # Model selection with nicer UI
-        model = st.selectbox(
-            "Select Claude Model",
-            ["claude-3-7-sonnet-20250219", "claude-3-5-sonnet-20240620", "claude-3-haiku-20240307"],
-            index=0,
-            key="model",
-            on_change=on_model_change
-        )
-        
-        st.markdown("---")
-        st.markdown("### 💬 Conversation")
-        
-        # Add a button to reset the conversation
-        if st.button("🔄 New Conversation"):
-            st.session_state.messages = []
-            st.session_state.conversation_history = []
-            st.rerun()
+        sidebar_ui(client)
     
+    # Add branding footer
+    st.markdown(
+        """
+        <div class="footer">
+            <span class="powered-by">Powered by Rapidata</span> • Human insights at scale
+        </div>
+        """, 
+        unsafe_allow_html=True
+    )
+
+    return client
+
+
+@st.fragment
+def chat_ui(client: MCPClient):
+    """Display the chat and handle new messages
+
+    Runs as a fragment, so submitting a message only reruns the chat and leaves
+    the CSS, sidebar and client initialization untouched. Fragment reruns happen
+    outside of main(), so the response is awaited on the app's event loop here.
+    """
     # Display chat messages with improved styling
-    for i, message in enumerate(st.session_state.messages):
-        role = message["role"]
-        content = message["content"]
-        msg_type = message.get("type", "text")
-        
-        # Different avatars based on message type
-        avatar = icons["user"] if role == "user" else icons["assistant"]
-        if msg_type == "tool_call":
-            avatar = icons["tool"]
-        elif msg_type == "tool_result":
-            avatar = icons["tool_result"]
-        
-        with st.chat_message(role, avatar=avatar):
-            if msg_type == "text":
-                st.write(content)
-            elif msg_type == "tool_call":
-                tool_name = message.get("name", "Unknown Tool")
-                st.markdown(f"<div class='tool-header'><span class='tool-name'>{tool_name}</span> Tool</div>", unsafe_allow_html=True)
-                st.json(content)
-            elif msg_type == "tool_result":
-                tool_name = message.get("for_tool", "Tool")
-                st.markdown(f"<div class='result-header'>Result from <span class='tool-name'>{tool_name}</span></div>", unsafe_allow_html=True)
-                st.markdown(f"```\n{content}\n```")
+    render_chat_history()
     
     # Chat input with placeholder text
     user_input = st.chat_input("Ask anything or request data from real humans...")
@@ -791,38 +1116,23 @@ async def main():
         with st.chat_message("user", avatar=icons["user"]):
             st.write(user_input)
         
-        # Format messages for API
-        api_messages = []
-        for msg in st.session_state.messages:
-            api_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
-        
         # Get Claude's response with a spinner
         with st.spinner("Rapidata is thinking..."):
             try:
-                await get_chat_response(user_input, client)
+                get_event_loop().run_until_complete(get_chat_response(user_input, client))
             except Exception as e:
+                # The failed turn was never committed, the next request doesn't start with what was sent
+                client.history_checkpoint = None
                 st.error(f"Error communicating with Claude API: {str(e)}")
-    
-    # Add branding footer
-    st.markdown(
-        """
-        <div class="footer">
-            <span class="powered-by">Powered by Rapidata</span> • Human insights at scale
-        </div>
-        """, 
-        unsafe_allow_html=True
-    )
 
 
 if __name__ == "__main__":
     st.set_page_config(
         page_title="Rapidata - Human Use",
-        page_icon=im,
+        page_icon=get_favicon(),
         initial_sidebar_state="collapsed",
     )
     
     loop = get_event_loop()
-    loop.run_until_complete(main())
+    client = loop.run_until_complete(main())
+    chat_ui(client)
@@ -1,46 +1,51 @@
 import os
 from mcp.server.fastmcp import FastMCP
-from openai import OpenAI
+from openai import AsyncOpenAI
+import asyncio
 import base64
 import logging
+from logging_config import configure_logging
+from pathlib import Path
 
 from dotenv import load_dotenv
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("image_generation.log"),
-        logging.StreamHandler()
-    ]
-)
+configure_logging("image_generation.log")
 logger = logging.getLogger(__name__)
 
 logger.info("Initializing FastMCP server with name 'image_generation'")
 mcp = FastMCP("image_generation")
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+IMAGE_DIRECTORY = "temp/generated_images"
+os.makedirs(IMAGE_DIRECTORY, exist_ok=True)
 
-def generate_and_save_image(prompt: str, file_name: str) -> str:
+# Limits the images generated at the same time, too many parallel requests run into OpenAI rate limits
+MAX_CONCURRENT_GENERATIONS = 8
+generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+
+
+async def generate_and_save_image(prompt: str, file_name: str) -> str:
     """
     Generate an image from a prompt and save it to a file.
+    The OpenAI client is async and reuses its connections, only the file write runs in a worker thread,
+    so several images can be generated at once.
     """
     
-    result = client.images.generate(
-        model="gpt-image-1",
-        prompt=prompt,
-        # quality="low"
-    )
+    async with generation_semaphore:
+        result = await client.images.generate(
+            model="gpt-image-1",
+            prompt=prompt,
+            # quality="low"
+        )
     image_base64 = result.data[0].b64_json
     image_bytes = base64.b64decode(image_base64)
     if not file_name.endswith(".png"):
         file_name = file_name + ".png"
-    file_path = f"temp/generated_images/{file_name}"
-    with open(file_path, "wb") as f:
-        f.write(image_bytes)
+    file_path = f"{IMAGE_DIRECTORY}/{file_name}"
+    await asyncio.to_thread(Path(file_path).write_bytes, image_bytes)
     return file_path
 
 @mcp.tool()
@@ -64,14 +69,12 @@ async def generate_image_from_text(
     if len(prompts) != len(file_names):
         raise ValueError("prompts and file_names must be the same length")
     
-    os.makedirs("temp/generated_images", exist_ok=True)
-
     if clear_directory_before_generation:
-        for file in os.listdir("temp/generated_images"):
-            os.remove(os.path.join("temp/generated_images", file))
+        old_files = await asyncio.to_thread(os.listdir, IMAGE_DIRECTORY)
+        await asyncio.gather(*[asyncio.to_thread(os.remove, os.path.join(IMAGE_DIRECTORY, file)) for file in old_files])
 
-    file_paths = [generate_and_save_image(prompt, file_name) for prompt, file_name in zip(prompts, file_names)]
-    return file_paths
+    file_paths = await asyncio.gather(*[generate_and_save_image(prompt, file_name) for prompt, file_name in zip(prompts, file_names)])
+    return list(file_paths)
 
 if __name__ == "__main__":
     logger.info("Starting FastMCP server for image generation")
@@ -0,0 +1,40 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Listener writing the queued records, set by the first configure_logging call
+_listener: QueueListener | None = None
+
+
+def configure_logging(log_file: str, level: int = logging.INFO) -> None:
+    """Log to a file and stderr without blocking the calling thread
+
+    The root logger only puts records on a queue, a background thread writes them to
+    the file and stderr. Only the first call configures logging, like logging.basicConfig,
+    so modules importing each other (and Streamlit reruns of app.py) can all call it.
+
+    Args:
+        log_file: Path of the log file, records are appended to it
+        level: Level of the root logger
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # Write the records still in the queue before the process exits
+    atexit.register(_listener.stop)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(QueueHandler(log_queue))
@@ -4,35 +4,134 @@ from contextlib import AsyncExitStack
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 from anthropic.types import Message
+from anthropic.lib.streaming import AsyncMessageStreamManager
 from dotenv import load_dotenv
-from typing import cast
+from typing import Any
 import logging
-from mcp.types import CallToolResult, TextContent
+from logging_config import configure_logging
+from mcp.types import CallToolResult, TextContent, Tool
 import os
+import orjson
+import base64
+import hashlib
+import copy
+import functools
+import re
+from pathlib import Path
 
 load_dotenv()  # load environment variables from .env
 
 # Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("rapidata_mcp.log"),
-        logging.StreamHandler()
-    ]
-)
+configure_logging("rapidata_mcp.log")
 logger = logging.getLogger(__name__)
 
 MODEL = "claude-3-7-sonnet-20250219"  # replace with your model name
+SUMMARY_MODEL = "claude-3-haiku-20240307"  # cheap model used to summarize old conversation turns
+
+# Once the conversation history exceeds this many input tokens, its oldest turns get summarized
+HISTORY_TOKEN_BUDGET = 8000
+# Number of most recent turns (a user query and everything answering it) kept verbatim
+KEEP_LAST_TURNS = 12
+
+# Average number of characters per token, used to estimate prompt sizes without an API call
+CHARS_PER_TOKEN = 4
+# Anthropic does not cache prompt prefixes shorter than this many tokens
+MIN_CACHEABLE_TOKENS = 1024
+# Marks the end of a prompt prefix that Anthropic should cache
+EPHEMERAL_CACHE = {"type": "ephemeral"}
+
+# Name of the built-in tool the model can call to load another group of tools
+ACTIVATE_GROUP_TOOL = "activate_tool_group"
+# Name of the built-in tool the model can call to get the full text of an elided tool result
+RETRIEVE_RESULT_TOOL = "retrieve_tool_result"
+
+# Tool results longer than this are shortened to their head and tail in the conversation history
+ELIDE_KEEP_HEAD = 400
+ELIDE_KEEP_TAIL = 200
+
+# Runs of escaped unicode characters (e.g. \u00e4) left in tool results by double encoding
+UNICODE_ESCAPE_RE = re.compile(r"(?:\\u[0-9a-fA-F]{4})+")
+# A single escaped character, a surrogate pair counts as one
+SINGLE_ESCAPE_RE = re.compile(r"\\u[dD][89abAB][0-9a-fA-F]{2}\\u[dD][c-fC-F][0-9a-fA-F]{2}|\\u[0-9a-fA-F]{4}")
+
+# Tool schemas are cached on disk so reconnecting to an unchanged server skips list_tools
+TOOL_CACHE_DIR = Path.home() / ".cache" / "human-use"
+
+
+def json_default(obj: Any) -> Any:
+    """Convert the values orjson can't serialize natively
+
+    Bytes become base64 text, pydantic models (e.g. MCP content) their JSON data,
+    anything else its string representation. Unset optional fields of the models are
+    left out, the Anthropic API rejects e.g. the "annotations": null of MCP content
+    when a stored history is sent again.
+    """
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode("ascii")
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json", exclude_none=True)
+    return str(obj)
+
+
+def _decode_escapes(match: re.Match) -> str:
+    """Decode a run of \\uXXXX escapes
+
+    If the run isn't valid text (e.g. it contains a lone surrogate), its characters are
+    decoded one by one and the ones that can't be decoded are kept escaped.
+    """
+    try:
+        return orjson.loads(f'"{match.group(0)}"')
+    except orjson.JSONDecodeError:
+        if len(SINGLE_ESCAPE_RE.findall(match.group(0))) > 1:
+            return SINGLE_ESCAPE_RE.sub(_decode_escapes, match.group(0))
+        logger.debug(f"Keeping undecodable escape {match.group(0)}")
+        return match.group(0)
+
+
+def approx_tokens(value: Any) -> int:
+    """Estimate the number of tokens of a JSON value, e.g. a list of messages
+
+    There is no local tokenizer for Claude models, so this uses the length of the
+    serialized value. That is accurate enough to decide about compaction and caching.
+    """
+    return len(orjson.dumps(value, default=json_default)) // CHARS_PER_TOKEN
+
+
+def _tool_cache_path(server_script_path: str) -> Path:
+    """Get the cache file for a server script, keyed by its path and modification time"""
+    mtime = os.path.getmtime(server_script_path)
+    key = hashlib.sha256(f"{os.path.abspath(server_script_path)}:{mtime}".encode("utf-8")).hexdigest()
+    return TOOL_CACHE_DIR / f"tools-{key}.json"
+
+
+def load_cached_tools(server_script_path: str) -> list[Tool] | None:
+    """Load the cached tool schemas of a server script, if there are any"""
+    try:
+        with open(_tool_cache_path(server_script_path), "rb") as f:
+            return [Tool.model_validate(tool) for tool in orjson.loads(f.read())]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Error reading tool cache for {server_script_path}: {e}")
+        return None
+
+
+def store_cached_tools(server_script_path: str, tools: list[Tool]):
+    """Store the tool schemas of a server script in the cache"""
+    try:
+        TOOL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(_tool_cache_path(server_script_path), "wb") as f:
+            f.write(orjson.dumps([tool.model_dump(mode="json") for tool in tools]))
+    except Exception as e:
+        logger.warning(f"Error writing tool cache for {server_script_path}: {e}")
+
 
 # Read in human prompting from markdown file
 def read_human_prompting():
     try:
-        with open("human_prompting.md", "r", encoding="utf-8") as f:
-            prompting = f.read()
-        return prompting
+        return Path("human_prompting.md").read_text(encoding="utf-8")
     except FileNotFoundError:
         logger.error("human_prompting.md file not found")
         return ""
@@ -40,20 +139,34 @@ def read_human_prompting():
         logger.error(f"Error reading human_prompting.md: {e}")
         return ""
 
-# Get initial system prompt
-PROMPTING_GUIDE = read_human_prompting()
+@functools.lru_cache(maxsize=1)
+def build_system_prompt() -> str:
+    """Build the system prompt, the prompting guide is only read once per process"""
+    return "You're a helpful assistant that has different tools at their disposal. You have the ability to ask REAL HUMANS using the rapidata API.\n\
+When you use the Rapidata tool, you may consider the prompting guides that are provided here: \n" + read_human_prompting() + "\n\
+If asked about something like 'i wonder what peoples favorite X is', feel free to first gather the free text options and then combine it with a classification to find out which option is the most popular.\
+If you can, use the classification tool instead of the free text tool as it is faster and cheaper."
 
 class MCPClient:
     def __init__(self, model: str = MODEL):
         self.sessions: dict[str, dict] = {}
+        self.server_groups: dict[str, str] = {}  # group name -> server script path
+        self.group_descriptions: dict[str, str] = {}  # group name -> description in the router tool
+        self.active_groups: set[str] = set()
+        self.tool_result_store: dict[str, str] = {}  # tool_use_id -> full text of an elided tool result
+        self.history_checkpoint: int | None = None  # number of messages sent with the previous request
         self.exit_stack = AsyncExitStack()
-        self.anthropic = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        self.connect_lock = asyncio.Lock()  # guards connecting servers, shared with the views
+        self.anthropic = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
         self.available_tools = []
+        self.anthropic_tools: list[dict] = []  # available_tools in the format expected by the Anthropic API
+        self.tool_sessions: dict[str, ClientSession] = {}  # tool name -> session of the server providing it
         self.model = model
-        self.system_prompt = "You're a helpful assistant that has different tools at their disposal. You have the ability to ask REAL HUMANS using the rapidata API.\n\
-When you use the Rapidata tool, you may consider the prompting guides that are provided here: \n" + PROMPTING_GUIDE + "\n\
-If asked about something like 'i wonder what peoples favorite X is', feel free to first gather the free text options and then combine it with a classification to find out which option is the most popular.\
-If you can, use the classification tool instead of the free text tool as it is faster and cheaper."
+
+    @property
+    def system_prompt(self) -> str:
+        """System prompt of every request, the same string is shared by all clients"""
+        return build_system_prompt()
     
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server and add its tools to the available tools
@@ -61,10 +174,47 @@ If you can, use the classification tool instead of the free text tool as it is f
         Args:
             server_script_path: Path to the server script (.py or .js)
         """
-        if not server_script_path:
-            logger.error("Server script path is empty")
-            return
-        
+        await self.connect_to_servers([server_script_path])
+
+    async def connect_to_servers(self, server_script_paths: list[str]):
+        """Connect to several MCP servers at once and add their tools to the available tools
+
+        The server processes are started one after the other, then their startup (most of
+        the time goes into the server importing its dependencies) overlaps. The connections
+        are entered in the calling task, which is the task that has to clean them up.
+
+        Args:
+            server_script_paths: Paths to the server scripts (.py or .js)
+        """
+        sessions = {}
+        for server_script_path in server_script_paths:
+            if not server_script_path:
+                logger.error("Server script path is empty")
+                continue
+            sessions[server_script_path] = await self._start_server(server_script_path)
+
+        server_tools = await asyncio.gather(*[self._initialize_server(path, session) for path, session in sessions.items()])
+
+        # Store sessions with their path and tools in the order of the paths, not the order the
+        # servers finished starting, so the tool order (and the cached prompt prefix) is stable
+        for (path, session), tools in zip(sessions.items(), server_tools):
+            self.sessions[path] = {
+                "session": session,
+                "tools": tools
+            }
+
+        # Update our combined list of available tools
+        self._update_available_tools()
+
+    async def _start_server(self, server_script_path: str) -> ClientSession:
+        """Start an MCP server process and open a session with it
+
+        Args:
+            server_script_path: Path to the server script (.py or .js)
+
+        Returns:
+            The session, not initialized yet
+        """
         is_python = server_script_path.endswith('.py')
         is_js = server_script_path.endswith('.js')
         print("Connecting to server script:", server_script_path)
@@ -86,39 +236,234 @@ If you can, use the classification tool instead of the free text tool as it is f
             logger.error(f"Failed to connect to server: {e}, error type: {type(e)}")
             raise
         stdio, write = stdio_transport
-        session = await self.exit_stack.enter_async_context(ClientSession(stdio, write))
+        return await self.exit_stack.enter_async_context(ClientSession(stdio, write))
+
+    async def _initialize_server(self, server_script_path: str, session: ClientSession) -> list[Tool]:
+        """Initialize the session with a started server and get the server's tools
 
+        Args:
+            server_script_path: Path to the server script
+            session: Session opened by _start_server
+
+        Returns:
+            The tools provided by the server
+        """
         await session.initialize()
 
-        # List available tools from this server
-        response = await session.list_tools()
-        server_tools = response.tools
+        # List available tools from this server, unless they are cached
+        server_tools = load_cached_tools(server_script_path)
+        if server_tools is None:
+            response = await session.list_tools()
+            server_tools = response.tools
+            store_cached_tools(server_script_path, server_tools)
         print("\nConnected to server with tools:", [tool.name for tool in server_tools])
-        
-        # Store session with its path and tools
-        self.sessions[server_script_path] = {
-            "session": session,
-            "tools": server_tools
-        }
-        
-        # Update our combined list of available tools
+        return server_tools
+
+    def register_server_group(self, group: str, server_script_path: str, description: str = ""):
+        """Register a group of tools without connecting to its server yet
+
+        Args:
+            group: Name of the tool group (e.g. "rapidata")
+            server_script_path: Path to the server script providing the tools
+            description: What the tools of the group are for, shown to the model in the router tool
+        """
+        self.server_groups[group] = server_script_path
+
+        # Described once, so the router tool (and the cached prompt prefix) stays the same even
+        # when connecting a server writes its tools to the cache later on
+        group_description = f"{group}: {description}" if description else group
+        cached_tools = load_cached_tools(server_script_path)
+        if cached_tools:
+            group_description += f" (tools: {', '.join(tool.name for tool in cached_tools)})"
+        self.group_descriptions[group] = group_description
+
+    async def activate_group(self, group: str):
+        """Connect to the server of a registered tool group so its tools become available
+
+        Args:
+            group: Name of the tool group
+        """
+        await self.activate_groups([group])
+
+    async def activate_groups(self, groups: list[str]):
+        """Connect to the servers of registered tool groups so their tools become available
+
+        The servers that are not connected yet are connected concurrently.
+
+        Args:
+            groups: Names of the tool groups
+        """
+        unknown_groups = [group for group in groups if group not in self.server_groups]
+        if unknown_groups:
+            raise ValueError(f"Unknown tool group {', '.join(map(str, unknown_groups))}")
+
+        # Views share the lock, so a server activated by two views at once is only connected once
+        async with self.connect_lock:
+            # The server may already be connected by another view on the same client
+            server_script_paths = {self.server_groups[group] for group in groups if group not in self.active_groups}
+            await self.connect_to_servers([path for path in server_script_paths if path not in self.sessions])
+        self.active_groups.update(groups)
         self._update_available_tools()
 
+    def create_view(self, model: str | None = None) -> "MCPClient":
+        """Create a per-conversation view on this client
+
+        The view shares the server connections, tool schemas and Anthropic client with
+        this client, but has its own model, active tool groups and stored tool results.
+        Only the original client should be cleaned up.
+
+        Args:
+            model: Model used by the view, defaults to the model of this client
+
+        Returns:
+            The new view
+        """
+        view = copy.copy(self)
+        view.model = model or self.model
+        view.active_groups = set(self.active_groups)
+        view.tool_result_store = {}
+        view.history_checkpoint = None
+        view._update_available_tools()
+        return view
+
+    def _activate_group_tool(self) -> dict | None:
+        """Get the definition of the tool that activates the tool groups not connected yet"""
+        inactive_groups = sorted(set(self.server_groups) - self.active_groups)
+        if not inactive_groups:
+            return None
+
+        group_descriptions = [self.group_descriptions[group] for group in inactive_groups]
+
+        return {
+            "name": ACTIVATE_GROUP_TOOL,
+            "description": "Load an additional group of tools. Only call this if none of the available tools can do the task.\n"
+                           f"Available groups: {'; '.join(group_descriptions)}",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "group": {"type": "string", "enum": inactive_groups}
+                },
+                "required": ["group"]
+            }
+        }
+
     def _update_available_tools(self):
-        """Update the complete list of all available tools from all connected servers"""
-        tools = []
-        for server_info in self.sessions.values():
-            tools.extend(server_info["tools"])
-        
-        # Filter out any duplicate tools (same name)
-        tool_names = set()
-        unique_tools = []
-        for tool in tools:
-            if tool.name not in tool_names:
-                tool_names.add(tool.name)
-                unique_tools.append(tool)
-        
-        self.available_tools = unique_tools
+        """Update the complete list of all available tools from all connected servers
+
+        Servers of tool groups that are not active are skipped, they may have been
+        connected by another view on the same client.
+        """
+        inactive_paths = {path for group, path in self.server_groups.items() if group not in self.active_groups}
+
+        # One pass over the servers refreshes the tools, their sessions and their Anthropic format.
+        # Duplicate tools (same name) are skipped, the first server providing a tool handles its calls
+        available_tools = {}
+        tool_sessions = {}
+        anthropic_tools = []
+        for path, server_info in self.sessions.items():
+            if path in inactive_paths:
+                continue
+            for tool in server_info["tools"]:
+                if tool.name in available_tools:
+                    continue
+                available_tools[tool.name] = tool
+                tool_sessions[tool.name] = server_info["session"]
+                anthropic_tools.append({
+                    "name": tool.name,
+                    "description": tool.description,
+                    "input_schema": tool.inputSchema
+                })
+
+        self.available_tools = list(available_tools.values())
+        self.tool_sessions = tool_sessions
+        self.anthropic_tools = anthropic_tools
+
+    def _request_params(self, history: list[dict]) -> dict:
+        """Build the parameters of a Claude request for the provided conversation history
+
+        Args:
+            history: List of message dictionaries with 'role' and 'content' keys
+
+        Returns:
+            Keyword arguments for the Anthropic messages API
+        """
+        # Copy the list, the built-in tools and cache breakpoint below must not end up in it
+        anthropic_tools = list(self.anthropic_tools)
+
+        # Tool groups that are not connected only cost a single router tool
+        activate_group_tool = self._activate_group_tool()
+        if activate_group_tool:
+            anthropic_tools.append(activate_group_tool)
+
+        # Elided tool results can be retrieved in full if the model actually needs them
+        if self.tool_result_store:
+            anthropic_tools.append({
+                "name": RETRIEVE_RESULT_TOOL,
+                "description": "Get the full text of a tool result that was shortened in the conversation history.",
+                "input_schema": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string", "description": "The id mentioned in the shortened tool result"}
+                    },
+                    "required": ["id"]
+                }
+            })
+
+        params = {
+            "model": self.model,
+            "max_tokens": 1000,
+            "system": [{"type": "text", "text": self.system_prompt}],
+            "messages": history,
+            "tools": anthropic_tools
+        }
+
+        # Prompts below the minimum cacheable size are sent without breakpoints
+        if approx_tokens(params) >= MIN_CACHEABLE_TOKENS:
+            # With no tools connected the system prompt breakpoint covers the same prefix
+            if anthropic_tools:
+                anthropic_tools[-1] = {**anthropic_tools[-1], "cache_control": EPHEMERAL_CACHE}
+            params["system"] = [{**params["system"][0], "cache_control": EPHEMERAL_CACHE}]
+            params["messages"] = self._apply_cache_control(history)
+
+        return params
+
+    def _apply_cache_control(self, messages: list[dict]) -> list[dict]:
+        """Return a copy of the messages with prompt cache breakpoints on the sent prefix and the last message
+
+        Anthropic has no server-side conversation state, so a turn is sent as the prefix of the
+        previous request plus the new messages. The breakpoint at the history checkpoint reads
+        the prefix the previous request wrote to the cache, only the delta after it is processed
+        again. The breakpoint on the last message writes the whole prompt for the next request.
+        Without a usable checkpoint the second to last message is marked instead.
+        Breakpoints left on the messages by earlier requests are removed, together with the
+        system prompt and tools this keeps the request at Anthropic's limit of four. The
+        provided messages are never modified.
+
+        Args:
+            messages: List of message dictionaries with 'role' and 'content' keys
+
+        Returns:
+            The messages with cache_control set on the last block of the breakpoint messages
+        """
+        if self.history_checkpoint and self.history_checkpoint < len(messages):
+            breakpoints = {self.history_checkpoint - 1, len(messages) - 1}
+        else:
+            breakpoints = {len(messages) - 2, len(messages) - 1}
+
+        cached_messages = []
+        for index, message in enumerate(messages):
+            content = message["content"]
+            if isinstance(content, list):
+                content = [
+                    {key: value for key, value in block.items() if key != "cache_control"} if "cache_control" in block else block
+                    for block in content
+                ]
+            if index in breakpoints and content:
+                if isinstance(content, str):
+                    content = [{"type": "text", "text": content}]
+                content[-1] = {**content[-1], "cache_control": EPHEMERAL_CACHE}
+            cached_messages.append({**message, "content": content})
+        return cached_messages
 
     async def get_response(self, history: list[dict]) -> Message:
         """Get a response from Claude using the provided conversation history
@@ -129,24 +474,106 @@ If you can, use the classification tool instead of the free text tool as it is f
         Returns:
             The Claude Message response
         """
-        # Convert our tools to the format expected by Anthropic API
-        anthropic_tools = [{
-            "name": tool.name,
-            "description": tool.description,
-            "input_schema": tool.inputSchema
-        } for tool in self.available_tools]
-        
         # Get response from Claude
-        response = self.anthropic.messages.create(
-            model=self.model,
-            max_tokens=1000,
-            system=self.system_prompt,
-            messages=history,
-            tools=anthropic_tools
-        )
+        params = self._request_params(history)
+        self.history_checkpoint = len(history)
+        response = await self.anthropic.messages.create(**params)
         
         return response
 
+    def estimate_prompt_tokens(self, history: list[dict]) -> int:
+        """Estimate the input tokens of a request with this history, including system prompt and tools"""
+        return approx_tokens(self._request_params(history))
+
+    def compaction_split(self, history: list[dict], max_tokens: int = HISTORY_TOKEN_BUDGET, keep_turns: int = KEEP_LAST_TURNS) -> int | None:
+        """Decide which oldest turns of the conversation history to summarize
+
+        A turn starts at a user query, so no tool_use is separated from its tool_result.
+        Once there are more than keep_turns turns, or the history exceeds max_tokens, the
+        older half is summarized. Going down to half leaves room to grow, so the summary
+        is only made every few turns instead of on every turn after the limit.
+
+        Args:
+            history: List of message dictionaries with 'role' and 'content' keys
+            max_tokens: Number of input tokens above which the history is compacted
+            keep_turns: Maximum number of most recent turns kept verbatim
+
+        Returns:
+            Index of the first kept message, the messages before it get summarized, or
+            None if the history is within budget
+        """
+        turn_starts = [
+            index for index, message in enumerate(history)
+            if message["role"] == "user" and not any(block.get("type") == "tool_result" for block in message["content"])
+        ]
+
+        if len(turn_starts) > keep_turns:
+            return turn_starts[-max(keep_turns // 2, 1)]
+        if len(turn_starts) > 1 and self.estimate_prompt_tokens(history) > max_tokens:
+            return turn_starts[-max(len(turn_starts) // 2, 1)]
+        return None
+
+    async def summarize_history(self, messages: list[dict]) -> str | None:
+        """Summarize the oldest messages of the conversation history with the cheap model
+
+        An earlier summary is part of the messages, so it rolls forward.
+
+        Args:
+            messages: The messages before the split returned by compaction_split
+
+        Returns:
+            The summary text, or None if it could not be made
+        """
+        try:
+            logger.info(f"Summarizing {len(messages)} messages of conversation history")
+            transcript = orjson.dumps(messages, default=json_default).decode()
+            summary = await self.anthropic.messages.create(
+                model=SUMMARY_MODEL,
+                max_tokens=1000,
+                system="Summarize this tool-use conversation between a user and an assistant. Preserve the tool_use ids, "
+                       "the questions asked, key entities, decisions and the results of tool calls. Answer with the summary only.",
+                messages=[{"role": "user", "content": transcript}]
+            )
+            return "".join(block.text for block in summary.content if block.type == "text")
+        except Exception as e:
+            logger.error(f"Error compacting conversation history: {str(e)}", exc_info=True)
+            return None
+
+    def apply_summary(self, history: list[dict], split_index: int, summary_text: str) -> list[dict]:
+        """Replace the messages before split_index with their summary
+
+        The summary is added in front of the first kept query. Only the start of the
+        history changes, so turns committed since the summary was started are kept as is.
+
+        Args:
+            history: The conversation history the split was computed on, or a continuation of it
+            split_index: Index of the first kept message
+            summary_text: Summary of the messages before it
+
+        Returns:
+            The compacted history
+        """
+        # The summarized history no longer starts with the prefix sent before
+        self.history_checkpoint = None
+
+        first_kept = history[split_index]
+        summary_block = {"type": "text", "text": f"<conversation_summary>\n{summary_text}\n</conversation_summary>"}
+        return [{**first_kept, "content": [summary_block, *first_kept["content"]]}] + history[split_index + 1:]
+
+    def stream_response(self, history: list[dict]) -> AsyncMessageStreamManager:
+        """Stream a response from Claude using the provided conversation history
+
+        Args:
+            history: List of message dictionaries with 'role' and 'content' keys
+
+        Returns:
+            An async context manager yielding the message stream. Text deltas are available
+            through its text_stream, the complete Message through get_final_message()
+        """
+        params = self._request_params(history)
+        self.history_checkpoint = len(history)
+        return self.anthropic.messages.stream(**params)
+
     async def use_tool(self, tool_name: str, tool_args: dict, id: str) -> CallToolResult:
         """Use a specific tool with the provided arguments
         
@@ -158,22 +585,84 @@ If you can, use the classification tool instead of the free text tool as it is f
         Returns:
             Dictionary with the tool result and metadata
         """
+        if tool_name == ACTIVATE_GROUP_TOOL:
+            group = tool_args.get("group")
+            # A failed activation is reported to the model, the other tool calls of the turn go on
+            try:
+                await self.activate_group(group)
+                tool_names = [tool.name for tool in self.sessions[self.server_groups[group]]["tools"]]
+            except Exception as e:
+                logger.error(f"Error activating tool group {group}: {str(e)}")
+                return CallToolResult(content=[TextContent(type='text', text=f"Could not activate tool group {group}: {str(e)}")], isError=True)
+            return CallToolResult(content=[TextContent(type='text', text=f"Activated tool group {group} with tools: {', '.join(tool_names)}")])
+
+        if tool_name == RETRIEVE_RESULT_TOOL:
+            full_text = self.tool_result_store.get(tool_args["id"])
+            if full_text is None:
+                return CallToolResult(content=[TextContent(type='text', text=f"No stored tool result with id {tool_args['id']}")], isError=True)
+            return CallToolResult(content=[TextContent(type='text', text=full_text)])
+
         # Find which server has this tool
-        server_path = None
-        for path, server_info in self.sessions.items():
-            if any(tool.name == tool_name for tool in server_info["tools"]):
-                server_path = path
-                break
-        
-        if not server_path:
+        session = self.tool_sessions.get(tool_name)
+        if session is None:
             raise ValueError(f"Tool {tool_name} not found in any connected server")
 
         # Execute tool call using the correct session
-        session = self.sessions[server_path]["session"]
-        session = cast(ClientSession, session)  # Ensure correct type
         result = await session.call_tool(tool_name, tool_args)
         return self.decode_results(result)
     
+    def commit_turn(self, history: list[dict], turn: list[dict]):
+        """Add a finished turn to the conversation history, with its long tool results shortened
+
+        During the turn Claude reads the tool results whole. Once it is finished they would
+        otherwise be resent on every later request, so they are shortened from then on.
+
+        Args:
+            history: The conversation history, the turn is appended to it
+            turn: Messages of the turn, from the user query to the final response
+        """
+        first_changed = None
+        for message in turn:
+            if message["role"] == "user" and isinstance(message["content"], list):
+                content = []
+                for block in message["content"]:
+                    if block.get("type") == "tool_result":
+                        elided = self.elide_content(block["tool_use_id"], block["content"])
+                        if elided is not block["content"]:
+                            block = {**block, "content": elided}
+                    content.append(block)
+                if first_changed is None and any(new is not old for new, old in zip(content, message["content"])):
+                    first_changed = len(history)
+                message = {**message, "content": content}
+            history.append(message)
+
+        # The requests of the turn cached it with the results in full, the next request
+        # only reads the cache up to the first shortened message
+        if first_changed is not None and self.history_checkpoint:
+            self.history_checkpoint = min(self.history_checkpoint, first_changed)
+
+    def elide_content(self, tool_use_id: str, content: list) -> list:
+        """Shorten a long tool result for the conversation history
+
+        The full text is kept in the tool_result_store and can be retrieved by the
+        model with the retrieve_tool_result tool.
+
+        Args:
+            tool_use_id: Id of the tool call
+            content: Content of the tool result
+
+        Returns:
+            The content to store in the conversation history, the same list if it is short
+        """
+        text = "".join(item.text for item in content if item.type == 'text')
+        if len(text) <= ELIDE_KEEP_HEAD + ELIDE_KEEP_TAIL:
+            return content
+
+        self.tool_result_store[tool_use_id] = text
+        elided_count = len(text) - ELIDE_KEEP_HEAD - ELIDE_KEEP_TAIL
+        elided_text = f"{text[:ELIDE_KEEP_HEAD]}…[{elided_count} characters elided, id={tool_use_id}]…{text[-ELIDE_KEEP_TAIL:]}"
+        return [TextContent(type='text', text=elided_text)] + [item for item in content if item.type != 'text']
+
     def decode_results(self, results: CallToolResult) -> CallToolResult:
         """Decode the results from Rapidata
 
@@ -183,26 +672,22 @@ If you can, use the classification tool instead of the free text tool as it is f
         Returns:
             CallToolResult: The decoded results
         """
-        decoded_contents = []
-
-        for content in results.content:
-            if content.type == 'text':
-                try:
-                    # Check if the text contains escape sequences that need decoding
-                    if '\\u' in content.text:
-                        decoded_text = content.text.encode('utf-8').decode('unicode_escape')
-                        decoded_contents.append(TextContent(type='text', text=decoded_text))
-                    else:
-                        # Keep the original text if no escape sequences
-                        decoded_contents.append(content)
-                except Exception as e:
-                    logger.error(f"Error decoding text: {str(e)}", exc_info=True)
-                    decoded_contents.append(content)
-            else:
-                decoded_contents.append(content)
+        decoded_contents = [self._decode_content(content) for content in results.content]
 
         return CallToolResult(content=decoded_contents, isError=results.isError)
     
+    def _decode_content(self, content: Any) -> Any:
+        """Decode the escape sequences of a text content, other content is returned as is
+
+        Only the escaped characters are replaced, the rest of the text (including non-ASCII
+        characters that are already decoded) is kept unchanged. A run of escapes is decoded
+        as a JSON string, so surrogate pairs become a single character. A run that can't be
+        decoded (e.g. a lone surrogate) is left as it is.
+        """
+        if content.type != 'text' or not UNICODE_ESCAPE_RE.search(content.text):
+            return content
+        return TextContent(type='text', text=UNICODE_ESCAPE_RE.sub(_decode_escapes, content.text))
+
     def get_available_tools_info(self) -> str:
         """Get information about available tools
         
@@ -252,8 +737,10 @@ async def chat_loop(client: MCPClient):
 async def main():
     client = MCPClient()
     try:
-        await client.connect_to_server("C:\\Rapidata\\Claude\\rapidata\\rapidata_human_api.py")
-        await client.connect_to_server("C:\\Rapidata\\Claude\\image-gen\\imagegen.py")
+        await client.connect_to_servers([
+            "C:\\Rapidata\\Claude\\rapidata\\rapidata_human_api.py",
+            "C:\\Rapidata\\Claude\\image-gen\\imagegen.py",
+        ])
         
         # Now the chat loop is separate from the MCPClient class
         await chat_loop(client)
@@ -261,4 +748,12 @@ async def main():
         await client.cleanup()
 
 if __name__ == "__main__":
+    # uvloop is a faster drop-in event loop, only available on Linux/macOS.
+    # Set here and not at import, app.py chooses the loop when it imports this module
+    if os.name != 'nt':
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
     asyncio.run(main())
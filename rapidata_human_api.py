@@ -1,24 +1,385 @@
 from mcp.server.fastmcp import FastMCP
 from rapidata import RapidataClient, LanguageFilter, LabelingSelection, RetrievalMode 
+import asyncio
+import contextlib
+import functools
+import hashlib
 import os
-from typing import Any, Optional
+import sqlite3
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import Any, Callable, Optional
 import logging
 
+import orjson
+
+from logging_config import configure_logging
+
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("rapidata_mcp.log"),
-        logging.StreamHandler()
-    ]
-)
+configure_logging("rapidata_mcp.log")
 logger = logging.getLogger(__name__)
 
 # Initialize FastMCP server
 logger.info("Initializing FastMCP server with name 'rapidata'")
 mcp = FastMCP("rapidata")
 
+# Shared by all tool calls, so the authentication and HTTP connections are reused
+_client: RapidataClient | None = None
+_client_lock = asyncio.Lock()
+
+
+async def _get_client() -> RapidataClient:
+    """Get the RapidataClient shared by all tool calls, it is created by the first call"""
+    global _client
+    if _client is None:
+        async with _client_lock:
+            # Another call may have created the client while this one waited for the lock
+            if _client is None:
+                logger.info("Creating RapidataClient")
+                # Creating the client authenticates, which blocks
+                _client = await asyncio.to_thread(RapidataClient)
+    return _client
+
+
+# Limits the blocking SDK calls running in worker threads at the same time
+MAX_CONCURRENT_SDK_CALLS = 8
+_sdk_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SDK_CALLS)
+
+# Threads waiting for the results of running orders, they only wait for people answering
+MAX_WAITING_ORDERS = 64
+_results_pool = ThreadPoolExecutor(max_workers=MAX_WAITING_ORDERS, thread_name_prefix="rapidata-results")
+
+
+async def _run_sdk_call(func: Callable[[], Any]) -> Any:
+    """Run a blocking Rapidata SDK call in a worker thread
+
+    The SDK is synchronous, running it in a thread lets the server handle other tool
+    calls meanwhile. Waiting for results goes through _wait_for_results instead.
+    """
+    async with _sdk_semaphore:
+        return await asyncio.to_thread(func)
+
+
+async def _wait_for_results(order: Any, **kwargs: Any) -> dict[str, Any]:
+    """Wait for the results of an order in a worker thread
+
+    get_results() blocks until the order is finished, which can take hours. It does not
+    take a slot of _sdk_semaphore, otherwise a few running orders would hold up the
+    creation of all others.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_results_pool, functools.partial(order.get_results, **kwargs))
+
+
+# Only files with these extensions are sent as image datapoints
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"})
+
+
+def _list_images(dir_path: str) -> list[str]:
+    """List the paths of the image files in a directory
+
+    Subdirectories and other files (e.g. .DS_Store) are skipped. scandir gets the
+    file type from the directory listing, only symlinks need an extra stat call.
+    """
+    with os.scandir(dir_path) as entries:
+        return [
+            entry.path for entry in entries
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+
+
+# Results of finished orders, so a tool called again with the same arguments does not
+# create a new order. Set RAPIDATA_DISABLE_CACHE=1 to always create new orders.
+RESULT_CACHE_ENABLED = os.getenv("RAPIDATA_DISABLE_CACHE", "0") != "1"
+# The least recently used result is dropped when the cache is full
+RESULT_CACHE_SIZE = 128
+_result_cache: OrderedDict[str, Any] = OrderedDict()
+
+# Set RAPIDATA_PERSIST_CACHE=1 to also store the results on disk, so they are reused
+# after the server restarts instead of paying for the same human responses again
+PERSIST_RESULT_CACHE = RESULT_CACHE_ENABLED and os.getenv("RAPIDATA_PERSIST_CACHE", "0") == "1"
+RESULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "rapidata_mcp", "results.sqlite3")
+# Hashes the contents of local files, for the persistent cache keys and to find duplicates
+_hash_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rapidata-hash")
+
+
+def _datapoint_fingerprint(datapoint: Any) -> Any:
+    """Identify a local file by its path, size and modification time
+
+    Generated images are saved under the same file names again, so the path alone
+    does not identify the image. Results persisted on disk outlive the files, so for
+    them the file is identified by its name and content instead. Other datapoints
+    (URLs, texts) identify themselves.
+    """
+    if isinstance(datapoint, str) and os.path.isfile(datapoint):
+        if PERSIST_RESULT_CACHE:
+            with open(datapoint, "rb") as f:
+                digest = hashlib.file_digest(f, "blake2b").hexdigest()
+            # The results are keyed by file name, so it is part of the identity
+            return [os.path.basename(datapoint), digest]
+        stat = os.stat(datapoint)
+        return [datapoint, stat.st_size, stat.st_mtime_ns]
+    return datapoint
+
+
+def _hash_tool_call(tool_name: str, datapoints: list, params: dict[str, Any]) -> str:
+    fingerprints = list(_hash_pool.map(_datapoint_fingerprint, datapoints))
+    key = orjson.dumps([tool_name, fingerprints, params], option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(key, digest_size=16).hexdigest()
+
+
+async def _result_cache_key(tool_name: str, datapoints: list, **params: Any) -> str | None:
+    """Build the result cache key of a tool call
+
+    Args:
+        tool_name: Name of the tool
+        datapoints: Datapoints of the order, local files are read in worker threads
+        params: All other arguments the results depend on
+
+    Returns:
+        The key, or None if the cache is disabled
+    """
+    if not RESULT_CACHE_ENABLED:
+        return None
+    return await asyncio.to_thread(_hash_tool_call, tool_name, datapoints, params)
+
+
+def _open_result_store() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(RESULT_CACHE_PATH), exist_ok=True)
+    connection = sqlite3.connect(RESULT_CACHE_PATH)
+    connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    return connection
+
+
+def _load_persisted_result(key: str) -> Any | None:
+    with contextlib.closing(_open_result_store()) as connection:
+        row = connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+    return orjson.loads(row[0]) if row else None
+
+
+def _persist_result(key: str, result: Any):
+    with contextlib.closing(_open_result_store()) as connection, connection:
+        connection.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, orjson.dumps(result)))
+
+
+async def _get_cached_result(key: str | None) -> Any | None:
+    """Get the cached results of a tool call, None if there are none
+
+    Results persisted on disk are loaded into the in-memory cache on first use.
+    """
+    if key is None:
+        return None
+    if key in _result_cache:
+        _result_cache.move_to_end(key)
+        return _result_cache[key]
+    if not PERSIST_RESULT_CACHE:
+        return None
+    try:
+        result = await asyncio.to_thread(_load_persisted_result, key)
+    except sqlite3.Error as e:
+        logger.error(f"Error loading persisted results: {str(e)}")
+        return None
+    if result is not None:
+        _remember_result(key, result)
+    return result
+
+
+async def _cache_result(key: str | None, result: Any):
+    """Cache the results of a tool call, errors should not be cached"""
+    if key is None:
+        return
+    _remember_result(key, result)
+    if PERSIST_RESULT_CACHE:
+        try:
+            await asyncio.to_thread(_persist_result, key, result)
+        except sqlite3.Error as e:
+            logger.error(f"Error persisting results: {str(e)}")
+
+
+def _remember_result(key: str, result: Any):
+    _result_cache[key] = result
+    _result_cache.move_to_end(key)
+    if len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+
+
+def _file_digest(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").digest()
+
+
+def _find_duplicate_files(datapoints: list[str]) -> tuple[list[str], dict[str, list[str]]]:
+    """Find local files with the same content, so each image is only labeled once
+
+    Only files of the same size can be duplicates, so only those are hashed.
+
+    Args:
+        datapoints: Paths of local files, other datapoints (URLs) are kept as they are
+
+    Returns:
+        The datapoints without the duplicates, and the file names of the duplicates of each kept file
+    """
+    paths_by_size = defaultdict(list)
+    for datapoint in datapoints:
+        if os.path.isfile(datapoint):
+            paths_by_size[os.path.getsize(datapoint)].append(datapoint)
+    candidates = [path for paths in paths_by_size.values() if len(paths) > 1 for path in paths]
+
+    kept_paths = {}
+    duplicates = defaultdict(list)
+    skipped = set()
+    for path, digest in zip(candidates, _hash_pool.map(_file_digest, candidates)):
+        if digest in kept_paths:
+            duplicates[os.path.basename(kept_paths[digest])].append(os.path.basename(path))
+            skipped.add(path)
+        else:
+            kept_paths[digest] = path
+    return [datapoint for datapoint in datapoints if datapoint not in skipped], dict(duplicates)
+
+
+def _copy_duplicate_results(results: dict[str, Any], duplicates: dict[str, list[str]]):
+    """Give each duplicate file the results of the file that was labeled in its place"""
+    for file_name, duplicate_names in duplicates.items():
+        if file_name in results:
+            for duplicate_name in duplicate_names:
+                results[duplicate_name] = results[file_name]
+
+
+async def _skip_duplicate_files(datapoints: list[str]) -> tuple[list[str], dict[str, list[str]]]:
+    """Run _find_duplicate_files in a worker thread and log the skipped files"""
+    unique_datapoints, duplicates = await asyncio.to_thread(_find_duplicate_files, datapoints)
+    if duplicates:
+        logger.info(f"Skipping {len(datapoints) - len(unique_datapoints)} duplicate images")
+    return unique_datapoints, duplicates
+
+
+# The SDK only reads selections and filters, so all orders share them
+@functools.cache
+def _selection(amount: int) -> LabelingSelection:
+    """Selection showing the given amount of random tasks per session"""
+    return LabelingSelection(amount=amount, retrieval_mode=RetrievalMode.Random)
+
+
+# Unbounded, there are only so many two letter language codes and invalid ones raise
+@functools.cache
+def _language_filters(language: str | None) -> tuple[LanguageFilter, ...]:
+    """Filters limiting an order to respondents speaking the language, none if it is not given"""
+    if not language:
+        return ()
+    return (LanguageFilter(language_codes=[language]),)
+
+
+# Pick the fields of the result rows used by the tools
+_free_text_result = itemgetter("originalFileName", "aggregatedResults")
+_classification_result = itemgetter("originalFileName", "summedUserScoresRatios")
+_aggregated_results = itemgetter("aggregatedResults")
+
+
+def _match_pair_results(pairs: list[tuple[str, str]], rows: list[dict[str, Any]]) -> dict[tuple[str, str], Any] | None:
+    """Match the result rows of a text comparison order to the compared pairs
+
+    The aggregated results of a row are keyed by the two texts, so rows are matched by
+    content. Only if the texts don't show up in the rows are they matched by position,
+    which needs exactly one row per pair.
+
+    Returns:
+        The aggregated results of each pair, or None if the rows can't be matched
+    """
+    by_texts = {frozenset(row["aggregatedResults"]): row["aggregatedResults"] for row in rows}
+    if all(frozenset(pair) in by_texts for pair in pairs):
+        return {pair: by_texts[frozenset(pair)] for pair in pairs}
+    if len(rows) != len(pairs):
+        return None
+    logger.warning("Text comparison results don't name the texts, matching them to the pairs by position")
+    return dict(zip(pairs, map(_aggregated_results, rows)))
+
+# Directories with more images are split into several orders running concurrently
+ORDER_CHUNK_SIZE = 32
+
+
+# Orders are only opened in the browser when RAPIDATA_VIEW=1, the MCP server usually
+# runs without anyone looking at it
+SHOW_ORDERS = os.getenv("RAPIDATA_VIEW", "0") == "1"
+
+
+async def _view_order(order: Any):
+    """Open the order in the browser if SHOW_ORDERS is set, errors are only logged"""
+    if not SHOW_ORDERS:
+        return
+    try:
+        await _run_sdk_call(order.view)
+    except Exception as e:
+        logger.error(f"Error viewing order: {str(e)}. Make sure to update your rapidata version.")
+
+
+async def _run_order_chunks(
+    datapoints: list,
+    create_order: Callable[[list, str], Any],
+    concurrency: int = MAX_CONCURRENT_SDK_CALLS,
+) -> list[dict[str, Any]]:
+    """Run one order per chunk of ORDER_CHUNK_SIZE datapoints and merge their results
+
+    Only for orders whose results are per datapoint, like classification and free text.
+
+    Args:
+        datapoints: Datapoints of all orders
+        create_order: Blocking function creating the order of a chunk, gets the chunk
+            and a suffix for the order name (empty if there is only one chunk)
+        concurrency: Maximum number of orders of this call being created at the same time,
+            all calls together never create more than MAX_CONCURRENT_SDK_CALLS. Waiting
+            for the results of created orders is not limited by it
+    Returns:
+        The results of all orders, in the order of the datapoints
+    Raises:
+        The error of the first failing order, the orders still running are paused
+        (including the ones still being created) and the chunks not started yet are cancelled
+    """
+    chunks = [datapoints[i:i + ORDER_CHUNK_SIZE] for i in range(0, len(datapoints), ORDER_CHUNK_SIZE)]
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    running_orders = set()
+
+    async def run_chunk(index: int, chunk: list) -> list[dict[str, Any]]:
+        name_suffix = f" ({index + 1}/{len(chunks)})" if len(chunks) > 1 else ""
+        # Same limit as _run_sdk_call, but only the upload is shielded from cancellation
+        async with semaphore, _sdk_semaphore:
+            creation = asyncio.ensure_future(asyncio.to_thread(lambda: create_order(chunk, name_suffix).run()))
+            try:
+                order = await asyncio.shield(creation)
+            except asyncio.CancelledError:
+                # Another chunk failed while this order was being created, the upload can't be
+                # stopped. The task group waits for this task, so it is paused once it exists
+                with contextlib.suppress(Exception):
+                    await _pause_orders({await creation})
+                raise
+        running_orders.add(order)
+        await _view_order(order)
+        results = (await _wait_for_results(order))["results"]
+        running_orders.discard(order)
+        return results
+
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            tasks = [task_group.create_task(run_chunk(index, chunk)) for index, chunk in enumerate(chunks)]
+    except ExceptionGroup as group:
+        # The results are incomplete anyway, the other orders would only collect paid responses nobody reads
+        await _pause_orders(running_orders)
+        raise group.exceptions[0] from None
+    return [result for task in tasks for result in task.result()]
+
+
+async def _pause_orders(orders: set[Any]):
+    """Pause orders, which also ends the get_results() calls waiting for them
+
+    Not limited by the SDK call semaphore, pausing should not wait for orders being created.
+    """
+    logger.info(f"Pausing {len(orders)} orders")
+    results = await asyncio.gather(*(asyncio.to_thread(order.pause) for order in orders), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error pausing order: {str(result)}")
+
+
 @mcp.tool()
 async def get_free_text_responses(
     name: str, 
@@ -26,6 +387,7 @@ async def get_free_text_responses(
     total_responses: int = 5,
     dir_path: Optional[str] = None,
     language: str | None = None,
+    concurrency: int = MAX_CONCURRENT_SDK_CALLS,
 ) -> dict[str, Any]:
     """get free text responses from humans
 
@@ -38,47 +400,58 @@ async def get_free_text_responses(
         dir_path (Optional[str]): path to the directory containing images. If not provided, a default image will be used.
             If provided, the images in the directory will be used as datapoints. (EACH datapoint will get the amount of responses specified in total_responses)
         language (str | None): The language the respondents speak. Has to be given as 2 LOWERCASE letters. If not provided, the question will be asked to all respondents.
+        concurrency (int): The maximum number of orders created at the same time. Directories with more than 32 images are split into
+            orders of 32 images. Lower it to stay within rate limits. defaults to 8 (which is also the maximum).
     Returns:
         dict[str, Any]: dictionary containing the final elo rankings of the images
     """
     logger.info(f"get_free_text_responses called with name: {name}, instruction: {instruction}")
-    logger.debug(f"Total responses: {total_responses}, dir_path: {dir_path}")
+    logger.debug("Total responses: %s, dir_path: %s", total_responses, dir_path)
     
     try:
-        client = RapidataClient()
-
         if dir_path is not None:
-            files = os.listdir(dir_path)
-            datapoints = [os.path.join(dir_path, f) for f in files]
-            logger.debug(f"Using images from directory: {dir_path}")
+            datapoints = await asyncio.to_thread(_list_images, dir_path)
+            logger.debug("Using images from directory: %s", dir_path)
         else:
             datapoints = ["https://assets.rapidata.ai/152c11b5-c428-4489-ad83-1651ebfe0efd.jpeg"]
             logger.debug("No directory path provided, using default image")
 
-        filters = []
-        if language:
-            filters.append(LanguageFilter(language_codes=[language]))
-
-        logger.info("Creating free text order")
-        order = client.order.create_free_text_order(
-            name=name,
-            instruction=instruction,
-            datapoints=datapoints,
-            responses_per_datapoint=total_responses,
-            selections=[LabelingSelection(amount=1, retrieval_mode=RetrievalMode.Random)],
-            filters=filters,
-        ).run()
-        
-        logger.info("Free text order created and run successfully")
-
-        try:
-            order.view()
-        except Exception as e:
-            logger.error(f"Error viewing order: {str(e)}. Make sure to update your rapidata version.")
-        
-        results = order.get_results()
-        processed_results = {result["originalFileName"]: result["aggregatedResults"] for result in results["results"]}
-        logger.debug(f"Free text results processed: {processed_results}")
+        if not datapoints or total_responses < 1:
+            logger.info("No images or responses requested, not creating an order")
+            return {}
+
+        cache_key = await _result_cache_key(
+            "get_free_text_responses", datapoints, instruction=instruction, total_responses=total_responses, language=language,
+        )
+        cached = await _get_cached_result(cache_key)
+        if cached is not None:
+            logger.info("Returning cached free text results")
+            return cached
+
+        client = await _get_client()
+        unique_datapoints, duplicates = await _skip_duplicate_files(datapoints)
+
+        logger.info("Creating free text orders")
+        results = await _run_order_chunks(
+            unique_datapoints,
+            lambda chunk, name_suffix: client.order.create_free_text_order(
+                name=name + name_suffix,
+                instruction=instruction,
+                datapoints=chunk,
+                responses_per_datapoint=total_responses,
+                selections=[_selection(1)],
+                filters=list(_language_filters(language)),
+            ),
+            concurrency,
+        )
+
+        logger.info("Free text orders created and run successfully")
+
+        processed_results = dict(map(_free_text_result, results))
+        _copy_duplicate_results(processed_results, duplicates)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Free text results processed: %r", processed_results)
+        await _cache_result(cache_key, processed_results)
         logger.info("Successfully retrieved free text results")
         
         return processed_results
@@ -94,6 +467,7 @@ async def get_human_image_classification(
     dir_path: Optional[str] = None,
     total_responses: int = 25,
     language: str | None = None,
+    concurrency: int = MAX_CONCURRENT_SDK_CALLS,
 ) -> list[dict[str, float]]:
     """get classification responses from humans
 
@@ -110,55 +484,156 @@ async def get_human_image_classification(
         total_responses (int): The total number of responses that will be collected. More responses will take longer but give a clearer results. defaults to 25.
             if a directory is provided, this will be the number of responses PER image.
         language (str | None): The language the respondants speak. Has to be given as 2 LOWERCASE letters. If not provided, the question will be asked to all respondants.
+        concurrency (int): The maximum number of orders created at the same time. Directories with more than 32 images are split into
+            orders of 32 images. Lower it to stay within rate limits. defaults to 8 (which is also the maximum).
     Returns:
         list[dict[str, float]]: list of dictionaries containing the classification results for each image
     """
     logger.info(f"get_human_image_classification called with name: {name}, instruction: {instruction}")
-    logger.debug(f"Answer options: {answer_options}, total_responses: {total_responses}, dir_path: {dir_path}")
+    logger.debug("Answer options: %s, total_responses: %s, dir_path: %s", answer_options, total_responses, dir_path)
     
     try:
-        client = RapidataClient()
-
         if dir_path is not None:
-            files = os.listdir(dir_path)
-            full_paths = [os.path.join(dir_path, f) for f in files]
-            logger.debug(f"Using images from directory: {dir_path}")
+            full_paths = await asyncio.to_thread(_list_images, dir_path)
+            logger.debug("Using images from directory: %s", dir_path)
         else:
             full_paths = ["https://assets.rapidata.ai/152c11b5-c428-4489-ad83-1651ebfe0efd.jpeg"]
             logger.debug("No directory path provided, using default image")
 
-        filters = []
-        if language:
-            filters.append(LanguageFilter(language_codes=[language]))
+        return await _classify(name, instruction, answer_options, full_paths, total_responses, language, concurrency)
+    except Exception as e:
+        logger.error(f"Error in get_human_image_classification: {str(e)}", exc_info=True)
+        return {"error": f"Failed to get classification results: {str(e)}"}
 
-        logger.info("Creating classification order")
-        order = client.order.create_classification_order(
-            name=name,
-            instruction=instruction,
-            answer_options=answer_options,
-            datapoints=full_paths,
-            responses_per_datapoint=total_responses,
-            filters=filters,
-            selections=[LabelingSelection(amount=3, retrieval_mode=RetrievalMode.Random)],
-        ).run()
 
-        logger.info("Classification order created and run successfully")
+@mcp.tool()
+async def batch_get_human_image_classification(
+    batches: list[dict[str, Any]],
+    name: str,
+    total_responses: int = 25,
+    language: str | None = None,
+) -> dict[str, Any]:
+    """get classification responses from humans for the images of several directories
+
+    Will ask actual humans to classify the images in each directory. Use this instead of calling
+    get_human_image_classification several times. If all batches have the same instruction and
+    answer options, their images are pooled into shared orders instead of orders per batch, which is faster.
 
-        try:
-            order.view()
-        except Exception as e:
-            logger.error(f"Error viewing order: {str(e)}. Make sure to update your rapidata version.")
-
-        results = order.get_results()["results"]
-        processed_results = {result["originalFileName"]: result["summedUserScoresRatios"] for result in results}
-        logger.debug(f"Classification results processed")
-        logger.info("Successfully retrieved classification results")
-        
+    Args:
+        batches (list[dict[str, Any]]): The directories to classify. Each batch is a dictionary with the keys
+            "id" (str, used as key of its results), "dir_path" (str, path to the directory containing images),
+            "instruction" (str, the question asked to the people) and "answer_options" (list[str], maximum 6 options).
+            (example [{"id": "cats", "dir_path": "images/cats", "instruction": "What is shown in the image?", "answer_options": ["cat", "dog"]}])
+        name (str): The name of the order (will not effect the results but used to identify the order).
+        total_responses (int): The number of responses collected PER image. More responses will take longer but give a clearer results. defaults to 25.
+        language (str | None): The language the respondants speak. Has to be given as 2 LOWERCASE letters. If not provided, the question will be asked to all respondants.
+    Returns:
+        dict[str, Any]: dictionary mapping the id of each batch to the classification results of its images
+    """
+    logger.info(f"batch_get_human_image_classification called with name: {name}, {len(batches)} batches")
+
+    try:
+        paths_per_batch = await asyncio.gather(
+            *(asyncio.to_thread(_list_images, batch["dir_path"]) for batch in batches)
+        )
+
+        # The results of the shared orders are matched to their batch by file name
+        batch_ids = {}
+        for batch, paths in zip(batches, paths_per_batch):
+            for path in paths:
+                batch_ids.setdefault(os.path.basename(path), batch["id"])
+        file_count = sum(len(paths) for paths in paths_per_batch)
+        questions = {(batch["instruction"], tuple(batch["answer_options"])) for batch in batches}
+
+        if len(questions) == 1 and len(batch_ids) == file_count:
+            logger.info(f"Classifying {file_count} images of {len(batches)} batches in shared orders")
+            instruction, answer_options = questions.pop()
+            results = await _classify(
+                name, instruction, list(answer_options),
+                [path for paths in paths_per_batch for path in paths], total_responses, language,
+            )
+            processed_results = {batch["id"]: {} for batch in batches}
+            for file_name, scores in results.items():
+                processed_results[batch_ids[file_name]][file_name] = scores
+            return processed_results
+
+        logger.info(f"Classifying {len(batches)} batches in separate orders")
+        results = await asyncio.gather(
+            *(
+                _classify(f"{name} - {batch['id']}", batch["instruction"], batch["answer_options"], paths, total_responses, language)
+                for batch, paths in zip(batches, paths_per_batch)
+            ),
+            return_exceptions=True,
+        )
+        processed_results = {}
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error classifying batch {batch['id']}: {str(result)}")
+                result = {"error": f"Failed to get classification results: {str(result)}"}
+            processed_results[batch["id"]] = result
         return processed_results
     except Exception as e:
-        logger.error(f"Error in get_human_image_classification: {str(e)}", exc_info=True)
+        logger.error(f"Error in batch_get_human_image_classification: {str(e)}", exc_info=True)
         return {"error": f"Failed to get classification results: {str(e)}"}
 
+
+async def _classify(
+    name: str,
+    instruction: str,
+    answer_options: list[str],
+    datapoints: list[str],
+    total_responses: int,
+    language: str | None,
+    concurrency: int = MAX_CONCURRENT_SDK_CALLS,
+) -> dict[str, dict[str, float]]:
+    """Run the classification orders of the datapoints and get their results
+
+    Errors are raised, the tools calling this turn them into error results.
+
+    Returns:
+        The summed user score ratios of each datapoint, keyed by file name
+    """
+    if not datapoints or total_responses < 1:
+        logger.info("No images or responses requested, not creating an order")
+        return {}
+
+    cache_key = await _result_cache_key(
+        "get_human_image_classification", datapoints, instruction=instruction, answer_options=answer_options, total_responses=total_responses, language=language,
+    )
+    cached = await _get_cached_result(cache_key)
+    if cached is not None:
+        logger.info("Returning cached classification results")
+        return cached
+
+    client = await _get_client()
+    unique_datapoints, duplicates = await _skip_duplicate_files(datapoints)
+
+    logger.info("Creating classification orders")
+    results = await _run_order_chunks(
+        unique_datapoints,
+        lambda chunk, name_suffix: client.order.create_classification_order(
+            name=name + name_suffix,
+            instruction=instruction,
+            answer_options=answer_options,
+            datapoints=chunk,
+            responses_per_datapoint=total_responses,
+            filters=list(_language_filters(language)),
+            selections=[_selection(3)],
+        ),
+        concurrency,
+    )
+
+    logger.info("Classification orders created and run successfully")
+
+    processed_results = dict(map(_classification_result, results))
+    _copy_duplicate_results(processed_results, duplicates)
+    logger.debug("Classification results processed")
+    await _cache_result(cache_key, processed_results)
+    logger.info("Successfully retrieved classification results")
+
+    return processed_results
+
+
 @mcp.tool()
 async def get_human_image_ranking(
     dir_path: str, 
@@ -182,35 +657,44 @@ async def get_human_image_ranking(
         dict[str, Any]: dictionary containing the final elo rankings of the images
     """
     logger.info(f"get_human_image_ranking called with name: {name}, instruction: {instruction}, dir_path: {dir_path}")
-    logger.debug(f"Total comparison budget: {total_comparison_budget}")
+    logger.debug("Total comparison budget: %s", total_comparison_budget)
     
     try:
-        client = RapidataClient()
-        
-        files = os.listdir(dir_path)
-        paths = [os.path.join(dir_path, f) for f in files]
-        logger.debug(f"Using images from directory: {dir_path}")
+        paths = await asyncio.to_thread(_list_images, dir_path)
+        logger.debug("Using images from directory: %s", dir_path)
+
+        if len(paths) < 2 or total_comparison_budget < 1:
+            logger.info("Less than two images or no comparisons requested, not creating an order")
+            return {}
+
+        cache_key = await _result_cache_key(
+            "get_human_image_ranking", paths, instruction=instruction, total_comparison_budget=total_comparison_budget,
+        )
+        cached = await _get_cached_result(cache_key)
+        if cached is not None:
+            logger.info("Returning cached ranking results")
+            return cached
+
+        client = await _get_client()
 
         logger.info("Creating ranking order")
-        order = client.order.create_ranking_order(
+        order = await _run_sdk_call(lambda: client.order.create_ranking_order(
             name=name,
             instruction=instruction,
             datapoints=paths,
             responses_per_comparison=1,
             total_comparison_budget=total_comparison_budget,
-            selections=[LabelingSelection(amount=3, retrieval_mode=RetrievalMode.Random)],
-        ).run()
+            selections=[_selection(3)],
+        ).run())
         
         logger.info("Ranking order created and run successfully")
         
-        try:
-            order.view()
-        except Exception as e:
-            logger.error(f"Error viewing order: {str(e)}. Make sure to update your rapidata version.")
+        await _view_order(order)
         
-        results = order.get_results()
+        results = await _wait_for_results(order)
         processed_results = results["summary"]
-        logger.debug(f"Ranking results processed")
+        logger.debug("Ranking results processed")
+        await _cache_result(cache_key, processed_results)
         logger.info("Successfully retrieved ranking results")
         
         return processed_results  
@@ -241,32 +725,58 @@ async def get_human_text_comparison(
         list[dict[str, int]]: list of dictionaries containing the comparison results for each pair of texts
     """
     logger.info(f"get_human_text_comparison called with name: {name}, instruction: {instruction}")
-    logger.debug(f"Total responses: {total_responses}, language: {language}")
+    logger.debug("Total responses: %s, language: %s", total_responses, language)
     
+    # A malformed pair would only fail after the order is created
+    if not all(
+        isinstance(pair, (list, tuple)) and len(pair) == 2 and all(isinstance(text, str) for text in pair)
+        for pair in text_pairs
+    ):
+        logger.error("Invalid text_pairs, each pair has to be a list of exactly two strings")
+        return {"error": "text_pairs has to be a list of pairs, each a list of exactly two strings"}
+    if not text_pairs or total_responses < 1:
+        logger.info("No text pairs or responses requested, not creating an order")
+        return []
+
     try:
-        client = RapidataClient()
+        cache_key = await _result_cache_key(
+            "get_human_text_comparison", text_pairs, instruction=instruction, total_responses=total_responses, language=language,
+        )
+        cached = await _get_cached_result(cache_key)
+        if cached is not None:
+            logger.info("Returning cached text comparison results")
+            return cached
+
+        client = await _get_client()
+
+        # Each distinct pair is only compared once
+        unique_pairs = list(dict.fromkeys(map(tuple, text_pairs)))
+        if len(unique_pairs) < len(text_pairs):
+            logger.info(f"Skipping {len(text_pairs) - len(unique_pairs)} duplicate text pairs")
 
         logger.info("Creating text comparison order")
-        order = client.order.create_compare_order(
+        order = await _run_sdk_call(lambda: client.order.create_compare_order(
             name=name,
             instruction=instruction,
-            datapoints=text_pairs,
+            datapoints=list(map(list, unique_pairs)),
             responses_per_datapoint=total_responses,
             data_type="text",
-            filters=[LanguageFilter(language_codes=[language])],
-            selections=[LabelingSelection(amount=2, retrieval_mode=RetrievalMode.Random)],
-        ).run()
+            filters=list(_language_filters(language)),
+            selections=[_selection(2)],
+        ).run())
 
         logger.info("Text comparison order created and run successfully")
 
-        try:
-            order.view()
-        except Exception as e:
-            logger.error(f"Error viewing order: {str(e)}. Make sure to update your rapidata version.")
+        await _view_order(order)
         
-        results = order.get_results()
-        processed_results = [result["aggregatedResults"] for result in results["results"]]
-        logger.debug(f"Text comparison results processed")
+        results = await _wait_for_results(order)
+        pair_results = _match_pair_results(unique_pairs, results["results"])
+        if pair_results is None:
+            logger.error(f"Got {len(results['results'])} text comparison results for {len(unique_pairs)} pairs")
+            return {"error": f"Got {len(results['results'])} text comparison results for {len(unique_pairs)} text pairs, they can't be matched"}
+        processed_results = [pair_results[tuple(pair)] for pair in text_pairs]
+        logger.debug("Text comparison results processed")
+        await _cache_result(cache_key, processed_results)
         logger.info("Successfully retrieved text comparison results")
         
         return processed_results
@@ -274,6 +784,60 @@ async def get_human_text_comparison(
         logger.error(f"Error in get_human_text_comparison: {str(e)}", exc_info=True)
         return {"error": f"Failed to compare texts: {str(e)}"}
 
+# State of an order whose results are final, get_status() returns it as a string
+ORDER_COMPLETED = "Completed"
+
+
+@mcp.tool()
+async def get_order_results(
+    order_id: str,
+    offset: int = 0,
+    limit: int = 256,
+    preliminary: bool = False,
+) -> dict[str, Any]:
+    """get the results of an existing order page by page
+
+    Use this to read the results of an order with many datapoints in smaller parts, or to look at the
+    responses collected so far while the order is still running.
+
+    Args:
+        order_id (str): The id of the order (it is part of the url of the order's page).
+        offset (int): The index of the first result to return. defaults to 0.
+        limit (int): The maximum number of results to return. defaults to 256.
+        preliminary (bool): If True, returns the results collected so far instead of waiting for the order to finish. defaults to False.
+            If False and the order is still running, this call blocks until the order is finished, paused or failed, which can take long.
+    Returns:
+        dict[str, Any]: dictionary with the "results" of this page (one entry per datapoint), the "total" number of results
+            and the "next_offset" to get the next page with (None if this is the last page)
+    """
+    logger.info(f"get_order_results called with order_id: {order_id}, offset: {offset}, limit: {limit}")
+
+    try:
+        # Results of a finished order don't change, so the next pages don't download them again
+        cache_key = None if preliminary else await _result_cache_key("get_order_results", [], order_id=order_id)
+        results = await _get_cached_result(cache_key)
+        if results is None:
+            client = await _get_client()
+            order = await _run_sdk_call(lambda: client.order.get_order_by_id(order_id))
+            results = (await _wait_for_results(order, preliminary_results=preliminary))["results"]
+            # A paused or failed order returns the results collected so far, they may still change
+            if cache_key is not None and await _run_sdk_call(order.get_status) == ORDER_COMPLETED:
+                await _cache_result(cache_key, results)
+
+        offset = max(offset, 0)
+        page = results[offset:offset + max(limit, 1)]
+        next_offset = offset + len(page)
+        logger.info(f"Returning {len(page)} of {len(results)} results")
+
+        return {
+            "results": page,
+            "total": len(results),
+            "next_offset": next_offset if next_offset < len(results) else None,
+        }
+    except Exception as e:
+        logger.error(f"Error in get_order_results: {str(e)}", exc_info=True)
+        return {"error": f"Failed to get order results: {str(e)}"}
+
 if __name__ == "__main__":
     logger.info("Starting FastMCP server for rapidata")
     
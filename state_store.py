@@ -0,0 +1,73 @@
+import logging
+import os
+
+import orjson
+
+from mcp_client import json_default
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Conversations are stored in Redis when this is set (e.g. redis://localhost:6379/0),
+# otherwise they only live in the Streamlit session state
+REDIS_URL = os.getenv("REDIS_URL")
+# A stored conversation expires this many seconds after its last turn
+CONVERSATION_TTL = 3600
+KEY_PREFIX = "human-use:conversation:"
+
+if REDIS_URL and redis is None:
+    logger.error("REDIS_URL is set but the redis package is not installed, conversations are not stored")
+STORE_ENABLED = bool(REDIS_URL) and redis is not None
+
+# Created on first use, so its connections belong to the event loop of the app
+_redis_client = None
+
+
+def get_redis_client():
+    """Get the Redis client shared by all sessions of this process"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL)
+    return _redis_client
+
+
+async def load_conversation(conversation_id: str) -> dict | None:
+    """Load a stored conversation
+
+    Args:
+        conversation_id: Id of the conversation
+
+    Returns:
+        The stored conversation, or None if there is none or no store is configured
+    """
+    if not STORE_ENABLED:
+        return None
+    try:
+        data = await get_redis_client().get(KEY_PREFIX + conversation_id)
+    except redis.RedisError as e:
+        logger.error(f"Error loading conversation {conversation_id}: {str(e)}")
+        return None
+    return orjson.loads(data) if data else None
+
+
+async def save_conversation(conversation_id: str, conversation: dict):
+    """Store a conversation, replacing the stored one and resetting its expiry
+
+    Does nothing if no store is configured. Errors are logged, the conversation
+    still continues in the session state.
+
+    Args:
+        conversation_id: Id of the conversation
+        conversation: JSON serializable conversation, MCP content is converted with json_default
+    """
+    if not STORE_ENABLED:
+        return
+    try:
+        data = orjson.dumps(conversation, default=json_default)
+        await get_redis_client().set(KEY_PREFIX + conversation_id, data, ex=CONVERSATION_TTL)
+    except redis.RedisError as e:
+        logger.error(f"Error saving conversation {conversation_id}: {str(e)}")
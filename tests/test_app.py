@@ -0,0 +1,39 @@
+import unittest
+
+import streamlit as st
+
+import app
+from mcp_client import MCPClient
+
+
+def cached_indexes(messages: list[dict]) -> list[int]:
+    """Indexes of the messages carrying a prompt cache breakpoint"""
+    return [
+        index for index, message in enumerate(messages)
+        if isinstance(message["content"], list) and any("cache_control" in block for block in message["content"])
+    ]
+
+
+class ResetConversationTest(unittest.TestCase):
+    def test_reset_forgets_sent_prefix(self):
+        client = MCPClient()
+        # A request of the old conversation sent 12 messages
+        client.history_checkpoint = 12
+        st.session_state.messages = []
+        st.session_state.conversation_history = []
+        st.session_state.compaction = None
+
+        app.reset_conversation(client)
+
+        # A new conversation long enough to be cached, and longer than the old checkpoint
+        history = [
+            {"role": "user" if index % 2 == 0 else "assistant", "content": [{"type": "text", "text": f"message {index} " * 100}]}
+            for index in range(20)
+        ]
+        params = client._request_params(history)
+        self.assertIsNone(client.history_checkpoint)
+        self.assertEqual(cached_indexes(params["messages"]), [18, 19])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from mcp.types import TextContent
+
+from mcp_client import ACTIVATE_GROUP_TOOL, MCPClient
+
+
+class ActivateGroupToolTest(unittest.IsolatedAsyncioTestCase):
+    """The router tool reports failed activations to the model instead of raising"""
+
+    def setUp(self):
+        self.client = MCPClient()
+        # Not a .py or .js file, so starting its server fails
+        self.client.register_server_group("broken", "server.txt")
+
+    async def test_unknown_group(self):
+        result = await self.client.use_tool(ACTIVATE_GROUP_TOOL, {"group": "nope"}, "toolu_1")
+        self.assertTrue(result.isError)
+        self.assertIn("Unknown tool group nope", result.content[0].text)
+
+    async def test_missing_group(self):
+        result = await self.client.use_tool(ACTIVATE_GROUP_TOOL, {}, "toolu_1")
+        self.assertTrue(result.isError)
+
+    async def test_server_fails_to_start(self):
+        result = await self.client.use_tool(ACTIVATE_GROUP_TOOL, {"group": "broken"}, "toolu_1")
+        self.assertTrue(result.isError)
+        self.assertIn("broken", result.content[0].text)
+        self.assertNotIn("broken", self.client.active_groups)
+
+
+class RouterToolTest(unittest.TestCase):
+    def test_describes_groups_never_connected(self):
+        client = MCPClient()
+        client.register_server_group("imagegen", "never_connected.py", "generate images from text prompts")
+        router = client._activate_group_tool()
+        self.assertIn("imagegen: generate images from text prompts", router["description"])
+        self.assertEqual(router["input_schema"]["properties"]["group"]["enum"], ["imagegen"])
+
+
+class DecodeContentTest(unittest.TestCase):
+    def decode(self, text: str) -> str:
+        return MCPClient()._decode_content(TextContent(type="text", text=text)).text
+
+    def test_valid_escapes(self):
+        self.assertEqual(self.decode(r"M\u00fcller \ud83d\ude00"), "Müller 😀")
+
+    def test_lone_surrogate_is_kept(self):
+        self.assertEqual(self.decode(r"caf\u00e9 \ud83d end"), r"café \ud83d end")
+
+    def test_lone_surrogate_next_to_valid_escape(self):
+        self.assertEqual(self.decode(r"caf\u00e9\ud83d\ud83d\ude00"), "café\\ud83d😀")
+
+
+if __name__ == "__main__":
+    unittest.main()
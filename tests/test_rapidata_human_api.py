@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+import rapidata_human_api as api
+
+
+class FakeCompareOrder:
+    """Order returning result rows keyed by the compared texts, like the Rapidata API"""
+
+    def __init__(self, rows: list[dict]):
+        self.rows = rows
+
+    def run(self):
+        return self
+
+    def get_results(self):
+        return {"results": self.rows}
+
+
+def compare_row(text_a: str, text_b: str, votes_a: int, votes_b: int) -> dict:
+    return {"aggregatedResults": {text_a: votes_a, text_b: votes_b}}
+
+
+class TextComparisonTest(unittest.IsolatedAsyncioTestCase):
+    async def compare(self, text_pairs: list[list[str]], rows: list[dict]):
+        client = mock.Mock()
+        client.order.create_compare_order.return_value = FakeCompareOrder(rows)
+        with mock.patch.object(api, "_client", client), mock.patch.object(api, "RESULT_CACHE_ENABLED", False):
+            return await api.get_human_text_comparison(text_pairs=text_pairs, name="test", instruction="Which is better?")
+
+    async def test_reordered_rows(self):
+        rows = [compare_row("c", "d", 1, 14), compare_row("a", "b", 10, 5)]
+        results = await self.compare([["a", "b"], ["c", "d"], ["a", "b"]], rows)
+        self.assertEqual(results, [{"a": 10, "b": 5}, {"c": 1, "d": 14}, {"a": 10, "b": 5}])
+
+    async def test_missing_rows(self):
+        rows = [compare_row("c", "d", 1, 14)]
+        results = await self.compare([["a", "b"], ["c", "d"]], rows)
+        self.assertIn("error", results)
+
+
+if __name__ == "__main__":
+    unittest.main()